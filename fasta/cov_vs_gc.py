@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
-"""Calculate k-mer coverage and GC content for a FASTA/FASTQ file."""
+"""
+Calculate k-mer coverage and GC content for a FASTA/FASTQ file. K-mers are counted as
+2-bit encoded integers (see utils/kmers.py); --strings counts them as Python strings.
+With -n or -p, k-mers are split into partitions by hash and spilled to disk, and each
+partition is counted separately in a pool of processes. With -g, a coverage x GC
+histogram of the k-mers is printed instead of one line per k-mer.
+"""
 
 import argparse
+import operator
+import os
 import sys
-from utils import calc_gc, read_fasta
+import tempfile
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+from utils import calc_gc, read_fasta, read_fasta_bytes, read_fasta_batches, open_reads, map_reduce_reads
+from utils.kmers import KmerCounter, CountMinSketch, gc_counts, batch_kmers, as_keys, from_keys, hash_kmers, \
+    num_words, spill_counts, read_partition
+
+SKETCH_SEED = 1 << 20  # Seed of the hash used to sample k-mers, independent of the sketch rows
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
 
 def get_kmers(sequence, k):
     """Returns a generator for iterating over k-mers in a sequence."""
@@ -13,20 +31,31 @@ def get_kmers(sequence, k):
     if type(k) != int:
         raise ValueError("k must be a length")
     
-    i = 0
-    while i <= (len(sequence) - k):
-        i += 1
+    for i in range(len(sequence) - k + 1):
         yield sequence[i:i+k]
 
 
-def count_kmer_coverage(fh, k):
+def reverse_complement(kmer):
+    """Returns the reverse complement of a k-mer string (other characters are kept)."""
+    return kmer.translate(COMPLEMENT)[::-1]
+
+
+def count_kmer_coverage(fh, k, fast=False, canonical=False):
     """
     Counts the occurrences of kmers in a given FASTA or FASTQ file handle.
-    Returns a dictionary of kmer -> coverage.
+    Returns a dictionary of kmer -> coverage. If fast is True, fh is parsed
+    with read_fasta_bytes. If canonical is True, each k-mer is counted as the
+    smaller of itself and its reverse complement.
     """
     kmer_cov = dict()
-    for _, seq, _, _ in read_fasta(fh):
+    if fast:
+        seqs = (seq.decode() for _, seq, _, _ in read_fasta_bytes(fh))
+    else:
+        seqs = (seq for _, seq, _, _ in read_fasta(fh))
+    for seq in seqs:
         for kmer in get_kmers(seq, k):
+            if canonical:
+                kmer = min(kmer, reverse_complement(kmer))
             if kmer not in kmer_cov:
                 kmer_cov[kmer] = 1
             else:
@@ -35,13 +64,179 @@ def count_kmer_coverage(fh, k):
     return kmer_cov
 
 
+def count_kmers(fh, k, canonical=False):
+    """
+    Counts the k-mers of ACGT bases in a binary FASTA or FASTQ file handle as 2-bit
+    encoded integers, in batches. Returns a KmerCounter.
+    """
+    counter = KmerCounter(k, canonical)
+    for batch in read_fasta_batches(fh):
+        counter.add_batch(batch)
+    return counter
+
+
+def batch_kmer_counts(batch, k, canonical=False):
+    """Returns a tuple (sorted unique keys, counts) of the k-mers in a FastxBatch."""
+    return np.unique(as_keys(batch_kmers(batch.seq, batch.offsets, k, canonical)), return_counts=True)
+
+
+def count_kmers_approx(filename, k, canonical=False, memory=1 << 30, threshold=2, fraction=1.0,
+                       depth=4):
+    """
+    Counts k-mers in two passes over filename with bounded memory. The first pass adds
+    every k-mer to a CountMinSketch of memory bytes. The second pass counts exactly only
+    the k-mers with an estimated count of at least threshold (and, if fraction < 1, a
+    hash-sampled fraction of them). Since estimates are never too low, every k-mer with
+    a true count of at least threshold is reported with its exact count; memory in the
+    second pass grows with the k-mers whose estimate passes the threshold, which is
+    bounded by the sketch error (see CountMinSketch). Returns (KmerCounter, sketch).
+    """
+    sketch = CountMinSketch.from_memory(memory, depth)
+    with open_reads(filename) as fh:
+        for batch in read_fasta_batches(fh):
+            keys, counts = batch_kmer_counts(batch, k, canonical)
+            sketch.add(from_keys(keys, num_words(k)), counts)
+
+    counter = KmerCounter(k, canonical)
+    sample_limit = int(fraction * float(1 << 64))
+    with open_reads(filename) as fh:
+        for batch in read_fasta_batches(fh):
+            keys, counts = batch_kmer_counts(batch, k, canonical)
+            kmers = from_keys(keys, num_words(k))
+            keep = sketch.query(kmers) >= threshold
+            if fraction < 1:
+                keep &= hash_kmers(kmers, SKETCH_SEED) < np.uint64(min(sample_limit, (1 << 64) - 1))
+            counter.add_counts(keys[keep], counts[keep])
+    return counter.filter(threshold), sketch
+
+
+def spill_batch(batch, k, canonical, num_partitions, directory):
+    """
+    Count the k-mers of a FastxBatch and append the counts to the run files of their
+    partitions in directory. Returns the number of distinct k-mers in the batch.
+    """
+    keys, counts = batch_kmer_counts(batch, k, canonical)
+    spill_counts(from_keys(keys, num_words(k)), counts, num_partitions, directory, os.getpid())
+    return len(keys)
+
+
+def count_partition(partition, directory, k, canonical, summarize):
+    """Count the k-mers spilled to a partition and return summarize(kmers, counts)."""
+    counter = KmerCounter(k, canonical)
+    for keys, counts in read_partition(directory, partition, counter.words):
+        counter.add_counts(keys, counts)
+    return summarize(*counter.kmers())
+
+
+def count_kmers_partitioned(filename, k, canonical, summarize, num_processes=1, num_partitions=64,
+                            tmp_dir=None):
+    """
+    Counts k-mers with memory bounded by the largest partition. K-mers are counted per
+    batch, split into num_partitions partitions by hash and spilled to run files in a
+    temporary directory (uncompressed files are parsed by num_processes processes).
+    Each partition is then counted in a pool of num_processes processes. Yields
+    summarize(kmers, counts) for each partition, in order; summarize must be picklable.
+    """
+    with tempfile.TemporaryDirectory(prefix="cov_vs_gc.", dir=tmp_dir) as directory:
+        spill = partial(spill_batch, k=k, canonical=canonical, num_partitions=num_partitions,
+                        directory=directory)
+        map_reduce_reads(filename, spill, operator.add, num_processes)
+        count = partial(count_partition, directory=directory, k=k, canonical=canonical,
+                        summarize=summarize)
+        if num_processes <= 1:
+            for partition in range(num_partitions):
+                yield count(partition)
+            return
+        with Pool(num_processes) as pool:
+            pending = deque()
+            for partition in range(num_partitions):
+                pending.append(pool.apply_async(count, (partition,)))
+                if len(pending) >= 2 * num_processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+
+def format_kmer_counts(kmers, counts, k):
+    """
+    Returns tab-separated coverage and GC content lines for a (kmers, words) array of
+    k-mers and their counts, with GC content calculated from the encoding.
+    """
+    gc = gc_counts(kmers).tolist()
+    return "".join("{0}\t{1}\n".format(count, g / k) for count, g in zip(counts.tolist(), gc))
+
+
+def print_kmer_output(counter, outfile):
+    """
+    Given a KmerCounter, calculate GC content of k-mers from their encoding and print
+    coverage and GC content in tab-separated format to outfile.
+    """
+    if outfile != sys.stdout:
+        outfile = open(outfile, "w")
+    kmers, counts = counter.kmers()
+    for start in range(0, len(counts), 1 << 16):
+        outfile.write(format_kmer_counts(kmers[start:start + (1 << 16)], counts[start:start + (1 << 16)],
+                                         counter.k))
+    if outfile != sys.stdout:
+        outfile.close()
+
+
+def kmer_histogram(kmers, counts, k, bin_width=1, max_cov=1000):
+    """
+    Returns a 2D histogram of the number of distinct k-mers by coverage (rows, bins of
+    bin_width, with k-mers of coverage >= max_cov in the last row) and by number of
+    G/C bases (k + 1 columns), counted from the 2-bit encoding.
+    """
+    num_rows = max_cov // bin_width + 1
+    rows = np.minimum(counts.astype(np.int64) // bin_width, num_rows - 1)
+    cells = rows * (k + 1) + gc_counts(kmers).astype(np.int64)
+    return np.bincount(cells, minlength=num_rows * (k + 1)).reshape(num_rows, k + 1)
+
+
+def counter_histogram(counter, bin_width=1, max_cov=1000):
+    """Returns the kmer_histogram of the k-mers in a KmerCounter."""
+    kmers, counts = counter.kmers()
+    hist = kmer_histogram(kmers[:0], counts[:0], counter.k, bin_width, max_cov)
+    for start in range(0, len(counts), 1 << 20):
+        hist += kmer_histogram(kmers[start:start + (1 << 20)], counts[start:start + (1 << 20)],
+                               counter.k, bin_width, max_cov)
+    return hist
+
+
+def print_histogram_output(hist, k, bin_width, outfile):
+    """
+    Print a coverage x GC histogram as a tab-separated matrix to outfile: a header of
+    GC contents, then one row per coverage bin (up to the last non-empty bin) starting
+    with the bin's lowest coverage.
+    """
+    if outfile != sys.stdout:
+        outfile = open(outfile, "w")
+    print("coverage", *["{0:.4g}".format(g / k) for g in range(k + 1)], sep="\t", file=outfile)
+    nonempty = np.flatnonzero(hist.sum(axis=1))
+    num_rows = nonempty[-1] + 1 if len(nonempty) else 0
+    for i, row in enumerate(hist[:num_rows].tolist()):
+        print(i * bin_width, *row, sep="\t", file=outfile)
+    if outfile != sys.stdout:
+        outfile.close()
+
+
+def print_partitioned_output(summaries, outfile):
+    """Print the output lines of each partition (see count_kmers_partitioned) to outfile."""
+    if outfile != sys.stdout:
+        outfile = open(outfile, "w")
+    for lines in summaries:
+        outfile.write(lines)
+    if outfile != sys.stdout:
+        outfile.close()
+
+
 def print_output(kmer_cov, outfile):
     """
     Given a dictionary of k-mers -> coverage, calculate GC content of k-mers
     and print in tab-separated format to outfile.
     """
     if outfile != sys.stdout:
-        outfile = open(outfile)
+        outfile = open(outfile, "w")
     
     for kmer in kmer_cov:
         gc = calc_gc(kmer)
@@ -57,7 +252,7 @@ def parse_args():
                                      "k-mers in FASTQ/FASTA sequences")
     parser.add_argument("input",
                         type=str,
-                        help="Input FASTA/FASTQ file (use '-' to read from stdin)")
+                        help="Input FASTA/FASTQ file, plain, gzip or BGZF (use '-' to read from stdin)")
     parser.add_argument("-k", "--kmer_length",
                         type=int,
                         default=80,
@@ -66,19 +261,115 @@ def parse_args():
                         type=str,
                         default=sys.stdout,
                         help="Output file [stdout]")
+    parser.add_argument("-c", "--canonical",
+                        action="store_true",
+                        help="Count canonical k-mers (a k-mer and its reverse complement together)")
+    parser.add_argument("-n", "--num_processes",
+                        type=int,
+                        default=1,
+                        help="Number of processes for partitioned counting [1]")
+    parser.add_argument("-p", "--partitions",
+                        type=int,
+                        default=None,
+                        help="Count k-mers in this many partitions spilled to disk, so memory is "
+                             "bounded by one partition [64 with -n > 1]")
+    parser.add_argument("-T", "--tmp_dir",
+                        type=str,
+                        default=None,
+                        help="Directory for partition files [system default]")
+    parser.add_argument("-g", "--hist",
+                        action="store_true",
+                        help="Print a coverage x GC histogram of k-mers instead of one line per k-mer")
+    parser.add_argument("-b", "--bin_width",
+                        type=int,
+                        default=1,
+                        help="Coverage bin width for --hist [1]")
+    parser.add_argument("--max_cov",
+                        type=int,
+                        default=1000,
+                        help="Coverage of the last bin with --hist, which also holds all higher "
+                             "coverages (rounded down to a multiple of --bin_width) [1000]")
+    parser.add_argument("--approx",
+                        action="store_true",
+                        help="Count k-mers in two passes with a count-min sketch of fixed size, "
+                             "reporting only k-mers seen at least --threshold times")
+    parser.add_argument("-m", "--memory",
+                        type=int,
+                        default=1024,
+                        help="Memory for the count-min sketch with --approx, in MB [1024]")
+    parser.add_argument("-t", "--threshold",
+                        type=int,
+                        default=2,
+                        help="Minimum k-mer count to report with --approx [2]")
+    parser.add_argument("-s", "--sample",
+                        type=float,
+                        default=1.0,
+                        help="Fraction of k-mers to report with --approx, sampled by hash [1.0]")
+    parser.add_argument("--strings",
+                        action="store_true",
+                        help="Count k-mers as strings, including k-mers with non-ACGT bases "
+                             "(slow, uses much more memory)")
+    parser.add_argument("-f", "--fast",
+                        action="store_true",
+                        help="Use the chunked byte-level reader with --strings")
     
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    if args.input == "-":
-        args.input = sys.stdin
+    if args.approx and args.strings:
+        print("cov_vs_gc.py: error: --approx cannot be used with --strings", file=sys.stderr, flush=True)
+        sys.exit(1)
+    partitioned = args.num_processes > 1 or args.partitions
+    for option in ("approx", "strings"):
+        if partitioned and getattr(args, option):
+            print("cov_vs_gc.py: error: --{0} cannot be used with partitioned counting (-n/-p)".format(option),
+                  file=sys.stderr, flush=True)
+            sys.exit(1)
+    if args.approx:
+        if args.input == "-":
+            print("cov_vs_gc.py: error: --approx reads the input twice and cannot read from stdin",
+                  file=sys.stderr, flush=True)
+            sys.exit(1)
+        counter, sketch = count_kmers_approx(args.input, args.kmer_length, args.canonical,
+                                             args.memory << 20, args.threshold, args.sample)
+        print("count-min sketch: {0} x {1}, {2} k-mers; estimates exceed true counts by more than "
+              "{3:.3g} with probability <= {4:.3g}".format(sketch.depth, sketch.width, sketch.total,
+              sketch.error_bound(), np.exp(-sketch.depth)), file=sys.stderr, flush=True)
+        if args.hist:
+            print_histogram_output(counter_histogram(counter, args.bin_width, args.max_cov), args.kmer_length,
+                                   args.bin_width, args.outfile)
+        else:
+            print_kmer_output(counter, args.outfile)
+        return
+    if args.strings and args.hist:
+        print("cov_vs_gc.py: error: --hist cannot be used with --strings", file=sys.stderr, flush=True)
+        sys.exit(1)
+    if args.strings:
+        args.input = open_reads(args.input, text=not args.fast)
+        kmer_cov = count_kmer_coverage(args.input, args.kmer_length, args.fast, args.canonical)
+        print_output(kmer_cov, args.outfile)
+    elif partitioned:
+        if args.hist:
+            summarize = partial(kmer_histogram, k=args.kmer_length, bin_width=args.bin_width, max_cov=args.max_cov)
+        else:
+            summarize = partial(format_kmer_counts, k=args.kmer_length)
+        summaries = count_kmers_partitioned(args.input, args.kmer_length, args.canonical, summarize,
+                                            args.num_processes, args.partitions or 64, args.tmp_dir)
+        if args.hist:
+            print_histogram_output(sum(summaries), args.kmer_length, args.bin_width, args.outfile)
+        else:
+            print_partitioned_output(summaries, args.outfile)
+        return
     else:
-        args.input = open(args.input)
-
-    kmer_cov = count_kmer_coverage(args.input, args.kmer_length)
-    print_output(kmer_cov, args.outfile)
+        args.input = open_reads(args.input)
+        counter = count_kmers(args.input, args.kmer_length, args.canonical)
+        if args.hist:
+            print_histogram_output(counter_histogram(counter, args.bin_width, args.max_cov), args.kmer_length,
+                                   args.bin_width, args.outfile)
+        else:
+            print_kmer_output(counter, args.outfile)
 
     args.input.close()
 
@@ -5,11 +5,12 @@
 
 import sys
 import argparse
-import numpy as np
-from utils import print_histogram
+from utils import StreamingHistogram
 
-def get_gene_lengths(gff):
-    """Returns a list of gene lengths from gff file."""
+GENE_BATCH_SIZE = 65536
+
+def get_gene_lengths(gff, batch_size=GENE_BATCH_SIZE):
+    """Yields lists of up to batch_size gene lengths from gff file."""
     gene_lengths = []
     with open(gff, "r") as fh:
         for line in fh:
@@ -22,16 +23,19 @@ def get_gene_lengths(gff):
                     start = int(line[3])
                     end = int(line[4])
                     gene_lengths.append(end-start)
-    return gene_lengths
+                    if len(gene_lengths) == batch_size:
+                        yield gene_lengths
+                        gene_lengths = []
+    if gene_lengths:
+        yield gene_lengths
 
 
-def print_named_histogram(gene_lengths, binwidth, name):
-    """Prints histogram of gene lengths with a given name."""
-    max_length = max(gene_lengths)
-    hist_max = (100 - (max_length % 100)) + max_length
-    counts, bins = np.histogram(gene_lengths, bins=hist_max//binwidth, range=(0, hist_max))
-    for i, b in enumerate(bins[1:]):
-        print(int(b), counts[i], name, sep="\t", flush=True)
+def get_gene_length_histogram(gff, binwidth):
+    """Returns a StreamingHistogram of the gene lengths in gff file."""
+    hist = StreamingHistogram(binwidth)
+    for gene_lengths in get_gene_lengths(gff):
+        hist.add(gene_lengths)
+    return hist
 
 
 def parse_args():
@@ -54,11 +58,8 @@ def parse_args():
 
 def main():
     args = parse_args()
-    gene_lengths = get_gene_lengths(args.gff)
-    if args.name is None:
-        print_histogram(gene_lengths, args.binwidth)
-    else:
-        print_named_histogram(gene_lengths, args.binwidth, args.name)
+    hist = get_gene_length_histogram(args.gff, args.binwidth)
+    hist.print_histogram(name=args.name)
 
 
 if __name__ == "__main__":
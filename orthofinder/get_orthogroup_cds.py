@@ -3,14 +3,22 @@
 
 import argparse
 import sys
-from utils import read_fasta
+from utils import read_fasta, read_fasta_bytes
 
-def load_fasta_sequences(fasta):
-    """Returns a dictionary of header -> sequence."""
+def load_fasta_sequences(fasta, fast=False):
+    """
+    Returns a dictionary of header -> sequence. If fast is True, the file is parsed
+    with read_fasta_bytes.
+    """
     seqs = {}
-    with open(fasta, "r") as fh:
-        for header, seq, _, _ in read_fasta(fh):
-            seqs[header] = seq
+    if fast:
+        with open(fasta, "rb") as fh:
+            for header, seq, _, _ in read_fasta_bytes(fh):
+                seqs[header.decode()] = seq.decode()
+    else:
+        with open(fasta, "r") as fh:
+            for header, seq, _, _ in read_fasta(fh):
+                seqs[header] = seq
     
     return seqs
 
@@ -44,6 +52,9 @@ def parse_args():
                         nargs="+",
                         help="mRNA sequences for species in orthogroup table. "
                              "Must be provided in the same order")
+    parser.add_argument("-f", "--fast",
+                        action="store_true",
+                        help="Use the chunked byte-level reader")
     return parser.parse_args()
 
 
@@ -60,7 +71,7 @@ def main():
     
     seqs = []
     for f in args.fastas:
-        seqs.append(load_fasta_sequences(f))
+        seqs.append(load_fasta_sequences(f, args.fast))
 
     print_orthogroup_genes(args.tsv, seqs, args.fastas)
 
@@ -1,20 +1,51 @@
 #!/usr/bin/env python3
-"""Calculate barcode multiplicity for an interleaved linked reads fastq file."""
+"""Calculate barcode multiplicity for an interleaved linked reads fastq file (plain, gzip or BGZF)."""
 
 import argparse
 import sys
-import numpy as np
-from utils import print_histogram, read_fasta
+from utils import StreamingHistogram, read_fasta, read_fasta_batches, map_reduce_reads, open_reads, BxIndex
+from utils.barcodes import BarcodeCounter
 
-def bx_multiplicity(rfile):
+def count_batch_bxs(batch):
+    """Returns a BarcodeCounter with the barcodes of a FastxBatch."""
+    return BarcodeCounter().add(batch.bxs)
+
+
+def merge_bx_counts(counter, other):
+    """Merge BarcodeCounter other into counter and return counter."""
+    return counter.update(other)
+
+
+def bx_counts(rfile, num_processes=1):
+    """
+    Count barcodes in a read file with packed barcode codes. Returns a BarcodeCounter.
+    If num_processes > 1, the file is parsed in parallel shards.
+    """
+    if rfile == "-":
+        rfile = "/dev/stdin"
+    if num_processes > 1:
+        return map_reduce_reads(rfile, count_batch_bxs, merge_bx_counts, num_processes) or BarcodeCounter()
+    counter = BarcodeCounter()
+    with open_reads(rfile) as reads:
+        if reads.isatty():
+            raise RuntimeError("Reads must be piped from stdin if file name is not provided")
+        for batch in read_fasta_batches(reads):
+            counter.add(batch.bxs)
+    return counter
+
+
+def bx_multiplicity(rfile, fast=False, num_processes=1):
     """
     Calculate barcode multiplicity given a read file name. Returns a dictionary
-    of barcode -> num reads with that barcode.
+    of barcode -> num reads with that barcode. If fast is True or num_processes > 1,
+    barcodes are counted in batches with bx_counts.
     """
+    if fast or num_processes > 1:
+        return bx_counts(rfile, num_processes).to_dict()
     bxs = {}
     if rfile == "-":
         rfile = "/dev/stdin"
-    with open(rfile) as reads:
+    with open_reads(rfile, text=True) as reads:
         if not reads.isatty():
             for _, _, bx, _ in read_fasta(reads):
                 if bx != None:
@@ -40,14 +71,36 @@ def get_args():
                         type=int,
                         default=1000,
                         help="Bin width for histogram")
+    parser.add_argument("-f", "--fast",
+                        action="store_true",
+                        help="Use the batched reader and packed barcode counting")
+    parser.add_argument("-n", "--num_processes",
+                        type=int,
+                        default=1,
+                        help="Number of processes to parse the read file with [1]")
+    parser.add_argument("-i", "--index",
+                        type=str,
+                        default=None,
+                        help="Barcode index built by utils/bx_index.py; read multiplicities "
+                             "from the index instead of the reads")
     return parser.parse_args()
 
 
 def main():
     args = get_args()
-    bx_mult = bx_multiplicity(args.reads)
-    multiplicities = [i for i in bx_mult.values()]
-    print_histogram(multiplicities, args.bin_width, args.output_file)
+    if args.index:
+        multiplicities = BxIndex.load(args.index).counts
+    elif args.fast or args.num_processes > 1:
+        multiplicities = bx_counts(args.reads, args.num_processes).multiplicities()
+    else:
+        bx_mult = bx_multiplicity(args.reads)
+        multiplicities = [i for i in bx_mult.values()]
+    hist = StreamingHistogram(args.bin_width).add(multiplicities)
+    if args.output_file is None:
+        hist.print_histogram()
+    else:
+        with open(args.output_file, "w+") as outfile:
+            hist.print_histogram(outfile)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Correct the BX tags of a linked reads fasta/fastq file against a barcode whitelist
+(e.g. 4M-with-alts-february-2016.txt). Barcodes in the whitelist are kept, barcodes one
+mismatch (or a single N) from exactly one whitelisted barcode are corrected, and the BX
+tag is removed from reads whose barcode cannot be corrected. Other header comment fields
+are kept unchanged.
+"""
+
+import argparse
+import itertools
+import re
+import sys
+from utils import open_reads, open_bgzf_writer
+from utils.read_fasta import read_fasta_bytes, BATCH_SIZE
+from utils.barcodes import BarcodeWhitelist
+
+BX_RE = re.compile(rb"(?:^|\s)BX:Z:(\S*)")
+
+def replace_bx(comment, match, tag):
+    """
+    Returns a header comment with the BX tag found by match replaced by tag, or with the
+    BX field removed if tag is None.
+    """
+    if tag is None:
+        comment = (comment[:match.start()] + comment[match.end():]).strip()
+        return comment or None
+    return comment[:match.start(1)] + tag + comment[match.end(1):]
+
+
+def format_records(records, comments):
+    """Returns (name, seq, qual) records with the given header comments as bytes."""
+    lines = []
+    for (name, seq, qual), comment in zip(records, comments):
+        header = name + b" " + comment if comment is not None else name
+        if qual is None:
+            lines.extend((b">" + header, seq))
+        else:
+            lines.extend((b"@" + header, seq, b"+", qual))
+    lines.append(b"")
+    return b"\n".join(lines)
+
+
+def correct_reads(read_file, whitelist, outfile):
+    """
+    Correct the barcodes of read_file and write the reads to the binary handle outfile.
+    Returns a dictionary of read counts by outcome.
+    """
+    stats = {"exact": 0, "corrected": 0, "uncorrected": 0, "no_bx": 0}
+    with open_reads(read_file) as fh:
+        records = read_fasta_bytes(fh, comments=True)
+        while True:
+            batch = list(itertools.islice(records, BATCH_SIZE))
+            if not batch:
+                break
+            comments = [comment for _, _, comment, _ in batch]
+            matches = [BX_RE.search(comment) if comment is not None else None for comment in comments]
+            has_bx = [i for i, match in enumerate(matches) if match is not None]
+            bxs = [matches[i].group(1) for i in has_bx]
+            for i, bx, tag in zip(has_bx, bxs, whitelist.correct_tags(bxs)):
+                comments[i] = replace_bx(comments[i], matches[i], tag)
+                if tag is None:
+                    stats["uncorrected"] += 1
+                elif tag == bx:
+                    stats["exact"] += 1
+                else:
+                    stats["corrected"] += 1
+            stats["no_bx"] += len(batch) - len(has_bx)
+            outfile.write(format_records([(name, seq, qual) for name, seq, _, qual in batch], comments))
+    return stats
+
+
+def get_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Correct the barcodes of a linked reads file "
+                                     "against a barcode whitelist")
+    parser.add_argument("-r", "--reads",
+                        type=str,
+                        default="-",
+                        help="Read file, plain, gzip or BGZF [stdin]")
+    parser.add_argument("-w", "--whitelist",
+                        type=str,
+                        required=True,
+                        help="Barcode whitelist, one barcode per line (plain or gzip)")
+    parser.add_argument("-o", "--outfile",
+                        type=str,
+                        default="-",
+                        help="Output file [stdout]")
+    parser.add_argument("-z", "--compress",
+                        action="store_true",
+                        help="Write output in BGZF (gzip-compatible) format")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    whitelist = BarcodeWhitelist.load(args.whitelist)
+    if len(whitelist) == 0:
+        print("correct_bx.py: error: no valid barcodes in whitelist", file=sys.stderr, flush=True)
+        sys.exit(1)
+    if args.compress:
+        outfile = open_bgzf_writer(args.outfile)
+    elif args.outfile == "-":
+        outfile = sys.stdout.buffer
+    else:
+        outfile = open(args.outfile, "wb")
+    stats = correct_reads(args.reads, whitelist, outfile)
+    if outfile is sys.stdout.buffer:
+        outfile.flush()
+    else:
+        outfile.close()
+    print("exact: {exact}, corrected: {corrected}, uncorrected: {uncorrected}, "
+          "no barcode: {no_bx}".format(**stats), file=sys.stderr, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,30 +2,55 @@
 """
 Filter, partition or subsample barcoded reads by a given read multiplicity range. Requires 
 a longranger basic-processed reads file and the unprocessed reads from supernova mkfastq. 
-Optionally subsamples reads to a certain coverage.
+Optionally subsamples reads to a certain coverage, or shards reads by barcode hash.
+Filter runs save periodic checkpoints and can be resumed with --resume.
 """
 
 import sys
-import gzip
 import os
 import math
 import time
 import re
 import argparse
 import glob
-
-def get_bx(read_file, min_reads, max_reads):
+import array
+import itertools
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils import open_reads, open_bgzf_writer
+from utils.bgzf import DEFAULT_THREADS, BgzfWriter
+from utils.open_reads import get_virtual_offset
+from utils.header_set import HeaderSet, hash_header, mix_hashes
+from utils.bx_index import BxIndex
+
+RECORD_BATCH_SIZE = 65536
+CHECKPOINT_INTERVAL = 600  # Seconds
+
+def get_bx(read_file, min_reads, max_reads, exact=False):
     """
     Opens read_file and gets the headers of reads with barcodes that have
-    at least min_reads and at most max_reads reads. Returns a tuple of dict, num headers
-    where dict = bx -> set(headers)
+    at least min_reads and at most max_reads reads. Reads must be grouped by barcode
+    (sort with sort_bx.py if they are not). Headers are stored as 64-bit
+    hashes. Returns a tuple of dict, header hashes, exact headers where
+    dict = bx -> (start, end) range of the barcode's headers in the uint64 hash array,
+    and exact headers is a set of the header strings if exact is True (else None).
     """
     prev_bx = None
     all_headers = {}
+    hashes = array.array("Q")
+    exact_headers = set() if exact else None
     cur_headers = set()
     cur_reads = 0
-    header_count = 0
-    with open(read_file) as fh:
+
+    def add_bx(bx, headers):
+        all_headers[bx] = (len(hashes), len(hashes) + len(headers))
+        hashes.extend(sorted(hash_header(h) for h in headers))
+        if exact:
+            exact_headers.update(headers)
+
+    with open_reads(read_file, text=True) as fh:
         if not fh.isatty():
             add_header = True
             for i, line in enumerate(fh):
@@ -36,8 +61,7 @@ def get_bx(read_file, min_reads, max_reads):
                         header = line_split[0]
                         if bx != prev_bx:  # Reached the next bx
                             if cur_reads >= min_reads and cur_reads <= max_reads:
-                                all_headers[prev_bx] = cur_headers
-                                header_count += len(cur_headers)
+                                add_bx(prev_bx, cur_headers)
                             add_header = True
                             cur_headers = {header}
                             cur_reads = 1
@@ -52,9 +76,8 @@ def get_bx(read_file, min_reads, max_reads):
                                     cur_headers.add(header)  # Store valid header
             # Add the last headers if valid
             if cur_reads >= min_reads and cur_reads <= max_reads:
-                all_headers[prev_bx] = cur_headers
-                header_count += len(cur_headers)
-            return all_headers, header_count
+                add_bx(prev_bx, cur_headers)
+            return all_headers, np.frombuffer(hashes, dtype=np.uint64), exact_headers
         else:
             print("filter_bx.py: error: barcoded reads must be piped from stdin or "
                 "provided with the -b parameter", file=sys.stderr, flush=True)
@@ -62,54 +85,176 @@ def get_bx(read_file, min_reads, max_reads):
 
 
 def get_reads(read_file, valid_headers):
-    """Given a list of valid headers, return a dictionary of header -> other read lines."""
+    """
+    Given a HeaderSet of valid headers, return a dictionary of header hash -> read lines.
+    """
     file_content = {}
-    with gzip.open(read_file, "rt") as reads:
-        add_lines = False
-        for i, line in enumerate(reads):
-            if i % 4 == 0:
-                cur_header = line.split(" ")[0]
-                if cur_header in valid_headers:
-                    add_lines = True
-                    file_content[cur_header] = [line.strip()]
-                else:
-                    add_lines = False
-            else:
-                if add_lines == True:
-                    file_content[cur_header].append(line.strip())
+    with open_reads(read_file, text=True) as reads:
+        for record in read_records(reads):
+            cur_header = record[0].split(None, 1)[0]
+            if cur_header in valid_headers:
+                file_content[hash_header(cur_header)] = [line.strip() for line in record]
     return file_content
 
 
-def filter_reads(read_1, read_2, new_1, new_2, valid_headers):
+def read_records(fh):
+    """Returns an iterator over 4-line fastq records in fh."""
+    it = iter(fh)
+    return zip(it, it, it, it)
+
+
+def read_record_batches(fh, batch_size=RECORD_BATCH_SIZE):
+    """Yields lists of up to batch_size 4-line fastq records from fh."""
+    records = read_records(fh)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def pair_name(name):
+    """Returns a read name without a /1 or /2 suffix."""
+    return name[:-2] if name[-2:] in ("/1", "/2") else name
+
+
+def read_paired_batches(fh1, fh2, batch_size=RECORD_BATCH_SIZE):
+    """
+    Yields (headers, batch1, batch2) tuples of paired record batches from two fastq file
+    handles, where headers are the read names of batch1. Raises ValueError if the files
+    have different numbers of reads or the names of a pair differ.
+    """
+    batches2 = read_record_batches(fh2, batch_size)
+    records = 0
+    for batch1 in read_record_batches(fh1, batch_size):
+        batch2 = next(batches2, [])
+        if len(batch2) != len(batch1):
+            raise ValueError("read files have different numbers of reads")
+        headers1 = [record[0].split(None, 1)[0] for record in batch1]
+        headers2 = [record[0].split(None, 1)[0] for record in batch2]
+        if headers1 != headers2:
+            for i, (header1, header2) in enumerate(zip(headers1, headers2)):
+                if pair_name(header1) != pair_name(header2):
+                    raise ValueError("read files are not in the same order at read {0} ({1} and {2})".format(
+                        records + i + 1, header1, header2))
+        yield headers1, batch1, batch2
+        records += len(batch1)
+    if next(batches2, None) is not None:
+        raise ValueError("read files have different numbers of reads")
+
+
+def format_records(records, newline="\n"):
+    """Returns 4-line fastq records (str, or bytes with newline=b"\n") as a single string."""
+    return newline[:0].join(newline.join(line.strip() for line in record) + newline for record in records)
+
+
+class Checkpoint:
+    """
+    Progress of a filter run, saved as JSON so that a killed run can be resumed. For
+    each input file it stores the uncompressed offset of the next record to read (and
+    its BGZF virtual offset, if the input is BGZF), the output file and the number of
+    bytes written to it, and whether the file is done. barcode_hash identifies the set
+    of valid headers the run was started with.
+    """
+    def __init__(self, filename, barcode_hash, interval=CHECKPOINT_INTERVAL, files=None):
+        self.filename = filename
+        self.barcode_hash = barcode_hash
+        self.interval = interval
+        self.files = files or {}
+        self.last_save = time.time()
+
+    @classmethod
+    def load(cls, filename, barcode_hash, interval=CHECKPOINT_INTERVAL):
+        """Load a saved checkpoint. Raises ValueError if it is for different barcodes."""
+        with open(filename) as fh:
+            state = json.load(fh)
+        if state["barcode_hash"] != barcode_hash:
+            raise ValueError("checkpoint '{0}' was made with a different set of valid barcodes".format(filename))
+        return cls(filename, barcode_hash, interval, state["files"])
+
+    def get(self, read_file):
+        """Returns the saved state of read_file."""
+        return self.files.get(read_file, {"offset": 0, "virtual_offset": None, "written": 0, "done": False})
+
+    def due(self):
+        """Returns True if a checkpoint should be saved."""
+        return self.interval > 0 and time.time() - self.last_save >= self.interval
+
+    def save(self, read_file, **state):
+        """Update the state of read_file and write the checkpoint atomically."""
+        self.files[read_file] = dict(self.get(read_file), **state)
+        tmp_name = self.filename + ".tmp"
+        with open(tmp_name, "w") as fh:
+            json.dump({"barcode_hash": self.barcode_hash, "files": self.files}, fh, indent=1)
+        os.replace(tmp_name, self.filename)
+        self.last_save = time.time()
+
+
+def barcode_state_hash(valid_headers):
+    """Returns a hex digest of the (sorted) header hashes of a HeaderSet."""
+    return hashlib.blake2b(valid_headers.hashes.tobytes(), digest_size=16).hexdigest()
+
+
+def open_output(file_name, written=0):
+    """
+    Open file_name for BGZF output. If written is nonzero, the file is truncated to
+    written bytes (the end of the last checkpoint) and appended to.
+    """
+    if not written:
+        return open_bgzf_writer(file_name)
+    if not os.path.exists(file_name) or os.path.getsize(file_name) < written:
+        raise ValueError("output file '{0}' is shorter than its checkpoint".format(file_name))
+    fh = open(file_name, "r+b")
+    fh.truncate(written)
+    fh.seek(written)
+    return BgzfWriter(fh)
+
+
+def sync_output(new_file):
+    """Write all data in a BGZF writer to disk. Returns the compressed bytes written."""
+    new_file.flush()
+    os.fsync(new_file.fileobj.fileno())
+    return new_file.fileobj.tell()
+
+
+def filter_reads(read_1, read_2, new_1, new_2, valid_headers, checkpoint=None):
     """
     Filters reads in paired-end read files that have a valid multiplicity
-    (present in valid_headers).
+    (present in the HeaderSet valid_headers). Output files are written in BGZF format.
+    If a Checkpoint is given, progress is saved every checkpoint interval and files
+    are resumed from their saved state.
     """
     files = {read_1: new_1, read_2: new_2}
     for read_file in files:
-        new_file = gzip.open(files[read_file], "wt")
-        with gzip.open(read_file, "rt") as fh:
-            for i, line in enumerate(fh):
-                if i % 4 == 0:
-                    if line.strip().split(" ")[0] in valid_headers:
-                        add_read = True
-                        print(line.strip(), file=new_file, flush=True)
-                    else:
-                        add_read = False
-                else:
-                    if add_read:
-                        print(line.strip(), file=new_file, flush=True)
+        state = checkpoint.get(read_file) if checkpoint else {"offset": 0, "virtual_offset": None, "written": 0}
+        if state.get("done"):
+            continue
+        offset = state["offset"]
+        new_file = open_output(files[read_file], state["written"])
+        with open_reads(read_file, offset=offset, virtual_offset=state["virtual_offset"]) as fh:
+            for batch in read_record_batches(fh):
+                keep = valid_headers.contains([record[0].split(None, 1)[0].decode() for record in batch])
+                new_file.write(format_records((batch[i] for i in np.flatnonzero(keep)), b"\n"))
+                offset += sum(map(len, itertools.chain.from_iterable(batch)))
+                if checkpoint and checkpoint.due():
+                    checkpoint.save(read_file, offset=offset, virtual_offset=get_virtual_offset(fh, offset),
+                                    output=files[read_file], written=sync_output(new_file))
+        if checkpoint:
+            written = sync_output(new_file)
         new_file.close()
+        if checkpoint:
+            checkpoint.save(read_file, offset=offset, virtual_offset=None, output=files[read_file],
+                            written=written, done=True)
 
 
-def partition_reads(r1_content, r2_content, new_r1_files, new_r2_files, valid_bx, num_reads):
+def partition_reads(r1_content, r2_content, new_r1_files, new_r2_files, valid_bx, header_hashes, num_reads):
     """
     Partition a given read file into new files with a given number of reads,
     filtering for reads present in valid_headers (with a certain bx multiplicity).
     """
     f = 0
-    cur_new_r1 = gzip.open(new_r1_files[f], "wt")
-    cur_new_r2 = gzip.open(new_r2_files[f], "wt")
+    cur_new_r1 = open_bgzf_writer(new_r1_files[f], text=True)
+    cur_new_r2 = open_bgzf_writer(new_r2_files[f], text=True)
     cur_reads = 0
     for bx in valid_bx:
         if cur_reads >= num_reads:
@@ -117,12 +262,13 @@ def partition_reads(r1_content, r2_content, new_r1_files, new_r2_files, valid_bx
                 cur_new_r2.close()
                 f += 1
                 try:
-                    cur_new_r1 = gzip.open(new_r1_files[f], "wt")
-                    cur_new_r2 = gzip.open(new_r2_files[f], "wt")
+                    cur_new_r1 = open_bgzf_writer(new_r1_files[f], text=True)
+                    cur_new_r2 = open_bgzf_writer(new_r2_files[f], text=True)
                 except IndexError:
                     return
                 cur_reads = 0
-        for h in valid_bx[bx]:
+        start, end = valid_bx[bx]
+        for h in header_hashes[start:end].tolist():
             print("\n".join(r1_content[h]), file=cur_new_r1)
             print("\n".join(r2_content[h]), file=cur_new_r2)
             cur_reads += 1
@@ -131,6 +277,91 @@ def partition_reads(r1_content, r2_content, new_r1_files, new_r2_files, valid_bx
     cur_new_r2.close()
 
 
+def assign_partitions(valid_bx, header_hashes, num_reads, num_files, exact_headers=None):
+    """
+    Assign the reads of each valid barcode to a partition, filling partitions with whole
+    barcodes (in the same order as partition_reads) until each has num_reads reads.
+    Returns a HeaderSet of header -> partition index. Reads of barcodes that do not fit
+    in num_files partitions are left out.
+    """
+    parts = np.full(len(header_hashes), -1, dtype=np.int32)
+    part = 0
+    cur_reads = 0
+    for start, end in valid_bx.values():
+        if cur_reads >= num_reads:
+            part += 1
+            cur_reads = 0
+            if part >= num_files:
+                break
+        parts[start:end] = part
+        cur_reads += end - start
+    assigned = parts >= 0
+    return HeaderSet(header_hashes[assigned], parts[assigned], exact_headers)
+
+
+def assign_shards(valid_bx, header_hashes, num_shards, exact_headers=None):
+    """
+    Assign the reads of each valid barcode to one of num_shards shards by a stable hash
+    of the barcode, so all reads of a barcode end up in the same shard. Returns a
+    HeaderSet of header -> shard index.
+    """
+    shards = np.full(len(header_hashes), -1, dtype=np.int32)
+    for bx, (start, end) in valid_bx.items():
+        if end > start:
+            shards[start:end] = hash_header(bx) % num_shards
+    assigned = shards >= 0
+    return HeaderSet(header_hashes[assigned], shards[assigned], exact_headers)
+
+
+def subsample_headers(valid_bx, header_hashes, num_reads, seed=0, by_read=False, exact_headers=None):
+    """
+    Deterministically choose about num_reads valid reads (pairs). Whole barcodes are
+    taken in order of a seeded hash of the barcode until num_reads is reached; if by_read
+    is True, the num_reads reads with the smallest seeded header hashes are taken instead.
+    Returns a HeaderSet of the chosen headers (value 0).
+    """
+    if by_read:
+        keys = mix_hashes(header_hashes, seed)
+        if num_reads < len(keys):
+            threshold = np.partition(keys, num_reads - 1)[num_reads - 1] if num_reads > 0 else None
+            keep = keys <= threshold if threshold is not None else np.zeros(len(keys), dtype=bool)
+        else:
+            keep = np.ones(len(keys), dtype=bool)
+    else:
+        ranges = [(bx, start, end) for bx, (start, end) in valid_bx.items() if end > start]
+        bx_keys = mix_hashes([hash_header(bx) for bx, _, _ in ranges], seed)
+        order = np.argsort(bx_keys, kind="stable")
+        counts = np.array([end - start for _, start, end in ranges], dtype=np.int64)[order]
+        num_bx = int(np.searchsorted(np.cumsum(counts), num_reads)) + 1 if num_reads > 0 else 0
+        keep = np.zeros(len(header_hashes), dtype=bool)
+        for i in order[:num_bx].tolist():
+            keep[ranges[i][1]:ranges[i][2]] = True
+    return HeaderSet(header_hashes[keep], np.zeros(int(keep.sum()), dtype=np.int32), exact_headers)
+
+
+def stream_partition_reads(read_1, read_2, new_r1_files, new_r2_files, assignment):
+    """
+    Walk read_1 and read_2 in lockstep and write each read pair with a header in
+    assignment to the files of its partition. Only the assignment is held in memory.
+    """
+    pool = ThreadPoolExecutor(DEFAULT_THREADS)
+    r1_out = [open_bgzf_writer(f, text=True, pool=pool) for f in new_r1_files]
+    r2_out = [open_bgzf_writer(f, text=True, pool=pool) for f in new_r2_files]
+    with open_reads(read_1, text=True) as r1, open_reads(read_2, text=True) as r2:
+        try:
+            for headers, batch1, batch2 in read_paired_batches(r1, r2):
+                parts = assignment.get_values(headers)
+                for i in np.flatnonzero(parts >= 0):
+                    r1_out[parts[i]].write(format_records([batch1[i]]))
+                    r2_out[parts[i]].write(format_records([batch2[i]]))
+        except ValueError as error:
+            print("filter_bx.py: error: {0}".format(error), file=sys.stderr, flush=True)
+            sys.exit(1)
+    for out in r1_out + r2_out:
+        out.close()
+    pool.shutdown()
+
+
 def get_range(multiplicity_str):
     """Read multiplicity range from string format min-max (inclusive)."""
     mult_split = [int(i) for i in multiplicity_str.split("-")]
@@ -169,15 +400,15 @@ def get_int(size_string):
         sys.exit(1)
 
 
-def get_new_file_names(read_prefix, read_suffix, min_mult, max_mult, num_files):
-    """Return a list of new read file names for partitioned reads."""
+def get_new_file_names(read_prefix, read_suffix, min_mult, max_mult, num_files, label="partition"):
+    """Return a list of new read file names for partitioned (or sharded) reads."""
     files = []
     for part in range(1, num_files + 1):
         if min_mult == -1 and max_mult == 9e32:  # Keeping all reads
             filter_name = "_all"
         else:
             filter_name = "{0}-{1}".format(min_mult, max_mult)
-        files.append(read_prefix + "_filterbx{0}_partition{1}".format(filter_name, part) + read_suffix)
+        files.append(read_prefix + "_filterbx{0}_{1}{2}".format(filter_name, label, part) + read_suffix)
     return files
 
 
@@ -195,7 +426,25 @@ def get_read_info(r1, r2):
         return read_prefix, read1_suffix, read2_suffix
 
 
-def run_filter(r1, r2, min_mult, max_mult, read_prefix, r1_suffix, r2_suffix, valid_headers):
+def get_checkpoint(checkpoint_file, valid_headers, resume, interval):
+    """Returns a Checkpoint for a filter run, loading the saved one if resume is True."""
+    barcode_hash = barcode_state_hash(valid_headers)
+    if resume:
+        if os.path.exists(checkpoint_file):
+            try:
+                checkpoint = Checkpoint.load(checkpoint_file, barcode_hash, interval)
+            except ValueError as error:
+                print("filter_bx.py: error: {0}".format(error), file=sys.stderr, flush=True)
+                sys.exit(1)
+            print("resuming from checkpoint {0}".format(checkpoint_file), file=sys.stderr, flush=True)
+            return checkpoint
+        print("no checkpoint found at {0}, starting from the beginning".format(checkpoint_file),
+            file=sys.stderr, flush=True)
+    return Checkpoint(checkpoint_file, barcode_hash, interval)
+
+
+def run_filter(r1, r2, min_mult, max_mult, read_prefix, r1_suffix, r2_suffix, valid_headers,
+               resume=False, checkpoint_interval=CHECKPOINT_INTERVAL):
     """Filter reads by barcode multiplicity."""
     if min_mult == -1 and max_mult == 9e32:
         filter_name = "_all"
@@ -203,26 +452,64 @@ def run_filter(r1, r2, min_mult, max_mult, read_prefix, r1_suffix, r2_suffix, va
         filter_name = "{0}-{1}".format(min_mult, max_mult)
     new_r1 = read_prefix + "_filterbx{0}".format(filter_name) + r1_suffix
     new_r2 = read_prefix + "_filterbx{0}".format(filter_name) + r2_suffix
+    checkpoint = None
+    if resume or checkpoint_interval > 0:
+        checkpoint_file = read_prefix + "_filterbx{0}.checkpoint".format(filter_name)
+        checkpoint = get_checkpoint(checkpoint_file, valid_headers, resume, checkpoint_interval)
     print("filtering reads...", file=sys.stderr, flush=True)
-    filter_reads(r1, r2, new_r1, new_r2, valid_headers)
+    try:
+        filter_reads(r1, r2, new_r1, new_r2, valid_headers, checkpoint)
+    except (ValueError, EOFError) as error:
+        print("filter_bx.py: error: cannot resume: {0}".format(error), file=sys.stderr, flush=True)
+        sys.exit(1)
+    if checkpoint and os.path.exists(checkpoint.filename):
+        os.remove(checkpoint.filename)
     print("reads filtered into new files:", new_r1, new_r2, sep="\n", flush=True)
 
 
-def run_partition(r1, r2, new_r1_files, new_r2_files, valid_bx, valid_headers, reads_per_file):
-    """Partition read files to a certain number of reads."""
+def run_partition(r1, r2, new_r1_files, new_r2_files, valid_bx, header_hashes, reads_per_file,
+                  in_memory=False, exact_headers=None):
+    """
+    Partition read files to a certain number of reads. By default reads are streamed
+    and routed to partitions by header; if in_memory is True, both read files are
+    loaded first and written out barcode by barcode.
+    """
+    if not in_memory:
+        print("partitioning reads...", file=sys.stderr, flush=True)
+        assignment = assign_partitions(valid_bx, header_hashes, reads_per_file, len(new_r1_files),
+                                       exact_headers)
+        stream_partition_reads(r1, r2, new_r1_files, new_r2_files, assignment)
+        return
+
+    valid_headers = HeaderSet(header_hashes, exact_headers=exact_headers)
     print("reading in r1...", file=sys.stderr, flush=True)
     r1_content = get_reads(r1, valid_headers)
     print("reading in r2...", file=sys.stderr, flush=True)
     r2_content = get_reads(r2, valid_headers)
     print("partitioning reads...", file=sys.stderr, flush=True)
-    partition_reads(r1_content, r2_content, new_r1_files, new_r2_files, valid_bx, reads_per_file)
+    partition_reads(r1_content, r2_content, new_r1_files, new_r2_files, valid_bx, header_hashes, reads_per_file)
+
+def run_subsample(r1, r2, new_r1_files, new_r2_files, valid_bx, header_hashes, num_reads,
+                  seed=0, by_read=False, exact_headers=None):
+    """Subsample read files to num_reads read pairs in one streaming pass."""
+    print("subsampling reads...", file=sys.stderr, flush=True)
+    chosen = subsample_headers(valid_bx, header_hashes, num_reads, seed, by_read, exact_headers)
+    stream_partition_reads(r1, r2, new_r1_files[:1], new_r2_files[:1], chosen)
+
+
+def run_shard(r1, r2, new_r1_files, new_r2_files, valid_bx, header_hashes, exact_headers=None):
+    """Split read files into shards by barcode hash in one streaming pass."""
+    print("sharding reads...", file=sys.stderr, flush=True)
+    assignment = assign_shards(valid_bx, header_hashes, len(new_r1_files), exact_headers)
+    stream_partition_reads(r1, r2, new_r1_files, new_r2_files, assignment)
+
 
 def get_args():
     """Parse the command line arguments."""
     parser = argparse.ArgumentParser(description="Filter or partition reads in a fastq file by \
                             barcode multiplicity or read coverage")
     parser.add_argument("mode",
-                        choices=["filter", "partition", "subsample"],
+                        choices=["filter", "partition", "subsample", "shard"],
                         default="filter")
     parser.add_argument("r1",
                         type=str,
@@ -250,10 +537,46 @@ def get_args():
                         type=str,
                         default=None,
                         help="Number of reads to include in each partition")
+    parser.add_argument("-k", "--num_shards",
+                        type=int,
+                        default=None,
+                        help="Number of output file pairs in shard mode")
+    parser.add_argument("-f", "--fraction",
+                        type=float,
+                        default=None,
+                        help="Fraction of valid reads to keep in subsample mode")
+    parser.add_argument("-s", "--seed",
+                        type=int,
+                        default=0,
+                        help="Seed for subsampling; the same seed gives the same reads [0]")
+    parser.add_argument("--by_read",
+                        action="store_true",
+                        help="Subsample individual read pairs instead of whole barcodes")
     parser.add_argument("-b", "--barcoded_reads",
                         type=str,
                         default="-",
-                        help="File containing barcoded reads [stdin]")
+                        help="File containing barcoded reads, grouped by barcode (see sort_bx.py) [stdin]")
+    parser.add_argument("-i", "--index",
+                        type=str,
+                        default=None,
+                        help="Barcode index built by utils/bx_index.py, used instead of "
+                             "scanning the barcoded reads")
+    parser.add_argument("--in_memory",
+                        action="store_true",
+                        help="Load both read files into memory to partition/subsample "
+                             "(writes reads grouped by barcode)")
+    parser.add_argument("--exact",
+                        action="store_true",
+                        help="Keep exact header strings to verify header hash matches "
+                             "(uses much more memory)")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="Resume an interrupted filter run from its last checkpoint")
+    parser.add_argument("--checkpoint_interval",
+                        type=int,
+                        default=CHECKPOINT_INTERVAL,
+                        help="Seconds between checkpoints in filter mode, 0 to disable [{0}]".format(
+                            CHECKPOINT_INTERVAL))
     return parser.parse_args()
 
 
@@ -267,9 +590,9 @@ def main():
     args.r1 = glob.glob(args.r1)[0]
     args.r2 = glob.glob(args.r2)[0]
 
-    if args.coverage and args.num_reads:
-        print("filter_bx.py: error: coverage and number of reads both provided. please provide one",
-            file=sys.stderr, flush=True)
+    if sum(x is not None for x in (args.coverage, args.num_reads, args.fraction)) > 1:
+        print("filter_bx.py: error: more than one of coverage, number of reads and fraction provided. "
+            "please provide one", file=sys.stderr, flush=True)
         sys.exit(1)
     
     if args.coverage:
@@ -281,6 +604,15 @@ def main():
 
     if args.num_reads:
         args.num_reads = get_int(args.num_reads)
+
+    if args.resume and args.mode != "filter":
+        print("filter_bx.py: error: --resume is only supported in filter mode", file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    if args.mode == "shard" and (args.num_shards is None or args.num_shards < 1):
+        print("filter_bx.py: error: a positive number of shards (-k) is required in shard mode",
+            file=sys.stderr, flush=True)
+        sys.exit(1)
     
     try:
         read_prefix, read1_suffix, read2_suffix = get_read_info(args.r1, args.r2)
@@ -294,14 +626,22 @@ def main():
         min_mult, max_mult = get_range(args.multiplicity)
 
     print("finding valid headers...", file=sys.stderr, flush=True)
-    if args.barcoded_reads == "-":
-        args.barcoded_reads = "/dev/stdin"
-    valid_bx, num_headers = get_bx(args.barcoded_reads, min_mult, max_mult)
-    valid_headers = set(h for bx in valid_bx.values() for h in bx)
-    total_valid_reads = num_headers * 2
+    if args.index:
+        if args.exact:
+            print("filter_bx.py: error: --exact requires scanning the barcoded reads and cannot "
+                "be used with --index", file=sys.stderr, flush=True)
+            sys.exit(1)
+        valid_bx, header_hashes, exact_headers = BxIndex.load(args.index).select(min_mult, max_mult)
+    else:
+        if args.barcoded_reads == "-":
+            args.barcoded_reads = "/dev/stdin"
+        valid_bx, header_hashes, exact_headers = get_bx(args.barcoded_reads, min_mult, max_mult, args.exact)
+    total_valid_reads = len(header_hashes) * 2
 
     if args.mode == "filter":  # Filter reads by bx multiplicity
-        run_filter(args.r1, args.r2, min_mult, max_mult, read_prefix, read1_suffix, read2_suffix, valid_headers)
+        valid_headers = HeaderSet(header_hashes, exact_headers=exact_headers)
+        run_filter(args.r1, args.r2, min_mult, max_mult, read_prefix, read1_suffix, read2_suffix, valid_headers,
+                   args.resume, args.checkpoint_interval)
 
     elif args.mode == "partition":  # Filter reads by bx multiplicity and partition
         if args.coverage:  # Partition by coverage
@@ -317,20 +657,40 @@ def main():
         print("{0} valid reads".format(total_valid_reads), file=sys.stderr, flush=True)
         print("partitioning each read direction into {0} files with approx. {1} reads each".format(new_files_per_read, reads_per_file),
         file=sys.stderr, flush=True)
-        run_partition(args.r1, args.r2, new_r1_files, new_r2_files, valid_bx, valid_headers, reads_per_file)
+        run_partition(args.r1, args.r2, new_r1_files, new_r2_files, valid_bx, header_hashes, reads_per_file,
+                      args.in_memory, exact_headers)
     
     elif args.mode == "subsample":  # Subsample reads
         if args.coverage:
             reads_per_file = ((args.coverage * args.genome) // args.read_length) // 2
         elif args.num_reads:
             reads_per_file = args.num_reads // 2
+        elif args.fraction is not None:
+            reads_per_file = round(args.fraction * len(header_hashes))
+        else:
+            print("filter_bx.py: error: coverage, number of reads or fraction required to subsample reads",
+                file=sys.stderr, flush=True)
+            sys.exit(1)
         
         new_r1_files = get_new_file_names(read_prefix, read1_suffix, min_mult, max_mult, 1)
         new_r2_files = get_new_file_names(read_prefix, read2_suffix, min_mult, max_mult, 1) 
         print("{0} valid reads".format(total_valid_reads), file=sys.stderr, flush=True)
         print("subsampling approx. {0} reads from each direction".format(reads_per_file),
             file=sys.stderr, flush=True)
-        run_partition(args.r1, args.r2, new_r1_files, new_r2_files, valid_bx, valid_headers, reads_per_file)
+        if args.in_memory:
+            run_partition(args.r1, args.r2, new_r1_files, new_r2_files, valid_bx, header_hashes, reads_per_file,
+                          True, exact_headers)
+        else:
+            run_subsample(args.r1, args.r2, new_r1_files, new_r2_files, valid_bx, header_hashes, reads_per_file,
+                          args.seed, args.by_read, exact_headers)
+
+    elif args.mode == "shard":  # Split reads into shards by barcode
+        new_r1_files = get_new_file_names(read_prefix, read1_suffix, min_mult, max_mult, args.num_shards, "shard")
+        new_r2_files = get_new_file_names(read_prefix, read2_suffix, min_mult, max_mult, args.num_shards, "shard")
+        print("{0} valid reads".format(total_valid_reads), file=sys.stderr, flush=True)
+        print("sharding each read direction into {0} files by barcode".format(args.num_shards),
+            file=sys.stderr, flush=True)
+        run_shard(args.r1, args.r2, new_r1_files, new_r2_files, valid_bx, header_hashes, exact_headers)
 
     print("DONE!", file=sys.stderr, flush=True)
     end = time.asctime()
@@ -1,44 +1,188 @@
 #!/usr/bin/env python3
-"""Interleave paired end fastq files."""
+"""
+Interleave paired end fastq files, or split an interleaved fastq file back into read 1
+and read 2 files. Reads are processed in blocks of whole records, with each input
+decompressed in its own thread, and read names are checked to make sure reads are paired.
+"""
 
 import sys
 import argparse
-import gzip
 import glob
+from concurrent.futures import ThreadPoolExecutor
+from utils import open_reads, open_bgzf_writer
 
-def interleave_reads(read1, read2, outfile):
-    """Combined reads from r1 and r2 in interleaved format and print to outfile."""
-    if outfile != sys.stdout:
-        outfile = open(outfile, "w+")
-    with gzip.open(read1, "rt") as r1, gzip.open(read2, "rt") as r2:
-        for i, line in enumerate(r1):
-                outfile.write(line)
-                if i % 4 == 3:
-                    for _ in range(4):
-                        outfile.write(r2.readline())
+BLOCK_RECORDS = 65536  # Records per block
+CHUNK_SIZE = 1 << 22
+BUFFER_SIZE = 1 << 20
+
+def read_line_blocks(fh, lines_per_block):
+    """
+    Yields lists of lines (bytes, without newlines) from a binary file handle, with
+    lines_per_block lines per list except the last.
+    """
+    lines = []
+    rest = b""
+    while True:
+        chunk = fh.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        split = (rest + chunk).split(b"\n")
+        rest = split.pop()
+        lines.extend(split)
+        while len(lines) >= lines_per_block:
+            yield lines[:lines_per_block]
+            del lines[:lines_per_block]
+    if rest:
+        lines.append(rest)
+    while lines and not lines[-1]:  # Trailing blank lines
+        lines.pop()
+    if lines:
+        yield lines
+
+
+def prefetch(blocks, pool):
+    """Yields the items of the iterator blocks, reading the next one in pool meanwhile."""
+    future = pool.submit(next, blocks, None)
+    while True:
+        block = future.result()
+        if block is None:
+            return
+        future = pool.submit(next, blocks, None)
+        yield block
+
+
+def read_name(header):
+    """Returns the read name of a fastq header, without a /1 or /2 suffix."""
+    name = header.split(None, 1)[0]
+    if name[-2:] in (b"/1", b"/2"):
+        name = name[:-2]
+    return name
+
+
+def check_pairs(lines1, lines2, first_record):
+    """Raise ValueError if the records in two blocks of lines are not paired by name."""
+    if len(lines1) % 4 or len(lines2) % 4:
+        raise ValueError("truncated fastq record near read {0}".format(first_record + len(lines1) // 4 + 1))
+    if len(lines1) != len(lines2):
+        raise ValueError("read files have different numbers of reads")
+    headers1 = lines1[0::4]
+    headers2 = lines2[0::4]
+    if [h.split(None, 1)[0] for h in headers1] == [h.split(None, 1)[0] for h in headers2]:
+        return
+    for i, (header1, header2) in enumerate(zip(headers1, headers2)):
+        if read_name(header1) != read_name(header2):
+            raise ValueError("read {0} is not paired ({1} and {2})".format(
+                first_record + i + 1, header1.decode(), header2.decode()))
+
+
+def open_output(outfile, compress=False):
+    """Open outfile ('-' or sys.stdout for stdout) as a buffered binary stream."""
+    if compress:
+        return open_bgzf_writer(outfile)
+    if outfile == "-" or outfile is sys.stdout:
+        return sys.stdout.buffer
+    return open(outfile, "wb", buffering=BUFFER_SIZE)
+
+
+def close_output(outfile):
+    """Close an output stream from open_output (stdout is only flushed)."""
+    if outfile is sys.stdout.buffer:
+        outfile.flush()
+    else:
+        outfile.close()
+
+
+def interleave_reads(read1, read2, outfile, compress=False):
+    """
+    Combined reads from r1 and r2 in interleaved format and print to outfile.
+    If compress is True, outfile is written in BGZF format.
+    """
+    out = open_output(outfile, compress)
+    lines_per_block = 4 * BLOCK_RECORDS
+    records = 0
+    with open_reads(read1) as r1, open_reads(read2) as r2, ThreadPoolExecutor(2) as pool:
+        blocks1 = prefetch(read_line_blocks(r1, lines_per_block), pool)
+        blocks2 = prefetch(read_line_blocks(r2, lines_per_block), pool)
+        for lines1 in blocks1:
+            lines2 = next(blocks2, [])
+            check_pairs(lines1, lines2, records)
+            merged = [None] * (len(lines1) * 2)
+            for j in range(4):
+                merged[j::8] = lines1[j::4]
+                merged[j + 4::8] = lines2[j::4]
+            merged.append(b"")
+            out.write(b"\n".join(merged))
+            records += len(lines1) // 4
+        if next(blocks2, None) is not None:
+            raise ValueError("read files have different numbers of reads")
+    close_output(out)
+
+
+def deinterleave_reads(infile, read1, read2, compress=False):
+    """
+    Split interleaved reads in infile into read1 and read2 files. If compress is True,
+    the output files are written in BGZF format.
+    """
+    out1 = open_output(read1, compress)
+    out2 = open_output(read2, compress)
+    lines_per_block = 8 * BLOCK_RECORDS
+    records = 0
+    with open_reads(infile) as fh, ThreadPoolExecutor(1) as pool:
+        for lines in prefetch(read_line_blocks(fh, lines_per_block), pool):
+            if len(lines) % 8:
+                raise ValueError("interleaved file has an odd number of reads or a truncated record")
+            lines1 = [None] * (len(lines) // 2)
+            lines2 = [None] * (len(lines) // 2)
+            for j in range(4):
+                lines1[j::4] = lines[j::8]
+                lines2[j::4] = lines[j + 4::8]
+            check_pairs(lines1, lines2, records)
+            lines1.append(b"")
+            lines2.append(b"")
+            out1.write(b"\n".join(lines1))
+            out2.write(b"\n".join(lines2))
+            records += len(lines) // 8
+    close_output(out1)
+    close_output(out2)
 
 
 def get_args():
     """Parse arguments from command line."""
-    parser = argparse.ArgumentParser(description="Interleave two paired end fastq read files")
+    parser = argparse.ArgumentParser(description="Interleave two paired end fastq read files, "
+                                     "or split an interleaved file with -d")
     parser.add_argument("r1",
                         type=str,
-                        help="Read 1 file (gzip)")
+                        help="Read 1 file (plain, gzip or BGZF); output file with -d")
     parser.add_argument("r2",
                         type=str,
-                        help="Read 2 file (gzip)")
+                        help="Read 2 file (plain, gzip or BGZF); output file with -d")
     parser.add_argument("-o", "--outfile",
                         type=str,
                         default=sys.stdout,
                         help="Output file for interleaved reads to be printed [stdout]")
+    parser.add_argument("-d", "--deinterleave",
+                        type=str,
+                        metavar="INTERLEAVED",
+                        default=None,
+                        help="Split this interleaved file ('-' for stdin) into r1 and r2 instead")
+    parser.add_argument("-z", "--compress",
+                        action="store_true",
+                        help="Write output in BGZF (gzip-compatible) format")
     return parser.parse_args()
 
 
 def main():
     args = get_args()
-    args.r1 = glob.glob(args.r1)[0]
-    args.r2 = glob.glob(args.r2)[0]
-    interleave_reads(args.r1, args.r2, args.outfile)
+    try:
+        if args.deinterleave:
+            deinterleave_reads(args.deinterleave, args.r1, args.r2, args.compress)
+        else:
+            args.r1 = glob.glob(args.r1)[0]
+            args.r2 = glob.glob(args.r2)[0]
+            interleave_reads(args.r1, args.r2, args.outfile, args.compress)
+    except ValueError as error:
+        print("interleave_fastq.py: error: {0}".format(error), file=sys.stderr, flush=True)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,59 +1,190 @@
 #!/usr/bin/env python3
 """
-Print a tsv file of read lengths or a histogram of read lengths.
-Expects reads to be in single-line fasta or fastq format (one line per read sequence).
+Print a tsv file of read lengths, a histogram of read lengths or read length statistics
+(N50, NG50, mean and quantiles). Reads (plain, gzip or BGZF, single or multi-line) are
+parsed in batches with utils.read_fasta_batches; statistics and histograms are computed
+in one streaming pass without keeping the lengths in memory.
 """
 
 import sys
 import argparse
+from functools import partial
 import numpy as np
+from utils import read_fasta_batches, open_reads, map_reduce_reads, StreamingHistogram
+
+SUB_BUCKET_BITS = 7  # 128 buckets per power of two, so bucket widths are < 1% of the length
+
+
+def bucket_index(lengths):
+    """
+    Returns the log-bucket index of each length. Lengths below 2 ** (SUB_BUCKET_BITS + 1)
+    get their own bucket; above that, each power of two is split into 2 ** SUB_BUCKET_BITS
+    equal buckets.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    shift = np.maximum(np.frexp(lengths.astype(np.float64))[1] - 1 - SUB_BUCKET_BITS, 0)
+    return (shift << SUB_BUCKET_BITS) + (lengths >> shift)
+
+
+class LengthStats:
+    """
+    Mergeable read length statistics: exact read and base counts, minimum and maximum,
+    and read and base counts per log bucket (see bucket_index). Memory is proportional
+    to the number of buckets, not the number of reads.
+    """
+    def __init__(self):
+        self.num_reads = 0
+        self.num_bases = 0
+        self.min_length = None
+        self.max_length = None
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.bases = np.zeros(0, dtype=np.int64)
+
+    def add(self, lengths):
+        """Add an array of read lengths and return self."""
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if len(lengths) == 0:
+            return self
+        self.num_reads += len(lengths)
+        self.num_bases += int(lengths.sum())
+        self.min_length = min(int(lengths.min()), self.min_length if self.min_length is not None else 1 << 62)
+        self.max_length = max(int(lengths.max()), self.max_length or 0)
+        index = bucket_index(lengths)
+        self.add_buckets(np.bincount(index), np.bincount(index, weights=lengths).astype(np.int64))
+        return self
+
+    def add_buckets(self, counts, bases):
+        """Add per-bucket read and base counts, growing the bucket arrays if needed."""
+        size = max(len(self.counts), len(counts))
+        self.counts = np.pad(self.counts, (0, size - len(self.counts)))
+        self.bases = np.pad(self.bases, (0, size - len(self.bases)))
+        self.counts[:len(counts)] += counts
+        self.bases[:len(bases)] += bases
+
+    def merge(self, other):
+        """Add the statistics of another LengthStats and return self."""
+        if other.num_reads:
+            self.num_reads += other.num_reads
+            self.num_bases += other.num_bases
+            self.min_length = other.min_length if self.min_length is None else min(self.min_length, other.min_length)
+            self.max_length = max(self.max_length or 0, other.max_length)
+            self.add_buckets(other.counts, other.bases)
+        return self
+
+    def mean(self):
+        """Returns the mean read length."""
+        return self.num_bases / self.num_reads if self.num_reads else 0
+
+    def bucket_length(self, i):
+        """Returns the mean length of the reads in bucket i, within the observed range."""
+        return min(max(round(self.bases[i] / self.counts[i]), self.min_length), self.max_length)
+
+    def nx(self, fraction, total=None):
+        """
+        Returns the Nx length (e.g. fraction=0.5 for N50): the length L such that reads
+        of length >= L hold at least fraction of total bases (default: all bases, which
+        gives NGx if total is a genome size). Returns None if the reads hold fewer bases.
+        """
+        total = self.num_bases if total is None else total
+        if self.num_reads == 0 or self.num_bases < fraction * total:
+            return None
+        covered = np.cumsum(self.bases[::-1])
+        i = len(self.bases) - 1 - int(np.searchsorted(covered, fraction * total))
+        return self.bucket_length(i)
+
+    def quantile(self, q):
+        """Returns the length of the read at quantile q (0-1) of all reads by length."""
+        if self.num_reads == 0:
+            return None
+        rank = min(int(q * self.num_reads), self.num_reads - 1)
+        i = int(np.searchsorted(np.cumsum(self.counts), rank, side="right"))
+        return self.bucket_length(i)
+
+    def summary(self, genome_size=None, quantiles=()):
+        """Returns a list of (statistic, value) tuples."""
+        stats = [("reads", self.num_reads), ("bases", self.num_bases),
+                 ("min", self.min_length), ("max", self.max_length),
+                 ("mean", round(self.mean(), 2)), ("N50", self.nx(0.5))]
+        if genome_size:
+            stats.append(("NG50", self.nx(0.5, genome_size)))
+        for q in quantiles:
+            stats.append(("q{0:g}".format(q * 100), self.quantile(q)))
+        return stats
+
+
+def batch_length_stats(batch):
+    """Returns the LengthStats of a FastxBatch."""
+    return LengthStats().add(batch.lengths())
+
+
+def merge_length_stats(stats, other):
+    """Merge two LengthStats."""
+    return stats.merge(other)
+
+
+def get_length_stats(read_file, num_processes=1):
+    """Returns the LengthStats of a read file, parsed in num_processes shards."""
+    return map_reduce_reads(read_file, batch_length_stats, merge_length_stats, num_processes) or LengthStats()
+
+
+def check_input(long_reads):
+    """Exit with an error if reads would be read from a terminal."""
+    if long_reads.isatty():
+        print("read_lengths: error: reads must be piped from stdin or given with the -r argument",
+            file=sys.stderr, flush=True)
+        sys.exit(1)
+
 
 def get_readlengths(read_file, outfile=None, print_lengths=True):
-    """Calculate and either print read lengths or return lengths as a list."""
+    """Calculate and either print read lengths or return lengths as an array."""
     lengths = []
-    with open(read_file, "rt") as long_reads:
-        if not long_reads.isatty():
+    with open_reads(read_file) as long_reads:
+        check_input(long_reads)
+        if print_lengths:
+            print("length", file=outfile)
+        for batch in read_fasta_batches(long_reads):
+            batch_lengths = batch.lengths()
             if print_lengths:
-                print("length", file=outfile, flush=True)
-            first = long_reads.readline()
-            if first[0] == "@":  # Fastq file
-                for i, line in enumerate(long_reads):
-                    if i % 4 == 0:
-                        cur_length = len(line.strip())
-                        if print_lengths:
-                            print(cur_length, file=outfile, flush=True)
-                        else:
-                            lengths.append(cur_length)
-            elif first[0] == ">":  # Fasta file
-                for i, line in enumerate(long_reads):
-                    if i % 2 == 0:
-                        cur_length = len(line.strip())
-                        if print_lengths:
-                            print(cur_length, file=outfile, flush=True)
-                        else:
-                            lengths.append(cur_length)
-            if not print_lengths:
-                return lengths
-        else:
-            print("read_lengths: error: reads must be piped from stdin or given with the -r argument",
-                file=sys.stderr, flush=True)
-            sys.exit(1)
-
-
-def print_histogram(read_lengths, bin_width, outfile):
-    """Print a histogram of read lengths and width of bin_width to outfile."""
-    max_length = max(read_lengths)
-    hist_max = (bin_width - (max_length % bin_width)) + max_length
-    counts, bins = np.histogram(read_lengths, bins=hist_max//bin_width, range=(0, hist_max))
+                print("\n".join(map(str, batch_lengths.tolist())), file=outfile)
+            else:
+                lengths.append(batch_lengths)
+        if not print_lengths:
+            return np.concatenate(lengths) if lengths else np.array([], dtype=np.int64)
+
+
+def batch_length_histogram(batch, bin_width):
+    """Returns a StreamingHistogram of the read lengths of a FastxBatch."""
+    return StreamingHistogram(bin_width).add(batch.lengths())
+
+
+def merge_histograms(hist, other):
+    """Merge two StreamingHistograms."""
+    return hist.merge(other)
+
+
+def get_length_histogram(read_file, bin_width, num_processes=1):
+    """Returns a StreamingHistogram of read lengths with bins of bin_width, in one pass."""
+    return map_reduce_reads(read_file, partial(batch_length_histogram, bin_width=bin_width), merge_histograms,
+                            num_processes) or StreamingHistogram(bin_width)
+
+
+def print_histogram(hist, outfile):
+    """Print a StreamingHistogram of read lengths with a header to outfile."""
     print("length", "count", sep="\t", file=outfile)
-    for i, b in enumerate(bins[1:]):
-        print(int(b), counts[i], sep="\t", file=outfile)
+    hist.print_histogram(outfile)
+
+
+def print_stats(stats, outfile, genome_size=None, quantiles=()):
+    """Print read length statistics as a tsv file to outfile."""
+    print("statistic", "value", sep="\t", file=outfile)
+    for name, value in stats.summary(genome_size, quantiles):
+        print(name, "NA" if value is None else value, sep="\t", file=outfile)
 
 
 def get_args():
     """Get command line arguments."""
-    parser = argparse.ArgumentParser(description="Print read lengths or a read length histogram \
-        for a long read file")
+    parser = argparse.ArgumentParser(description="Print read lengths, a read length histogram \
+        or read length statistics for a long read file")
     parser.add_argument("-r", "--reads",
                         type=str,
                         default="-",
@@ -66,6 +197,22 @@ def get_args():
                         type=int,
                         default=1000,
                         help="Desired bin width for histogram [1000]")
+    parser.add_argument("-s", "--stats",
+                        action="store_true",
+                        help="Print read length statistics (N50, mean, quantiles; lengths "
+                             "above 256 bp are estimated to within 1%%)")
+    parser.add_argument("-G", "--genome_size",
+                        type=float,
+                        default=None,
+                        help="Genome size for NG50 with --stats (e.g. 3e9)")
+    parser.add_argument("-q", "--quantiles",
+                        type=str,
+                        default="0.1,0.25,0.5,0.75,0.9",
+                        help="Comma-separated read length quantiles for --stats [0.1,0.25,0.5,0.75,0.9]")
+    parser.add_argument("-n", "--num_processes",
+                        type=int,
+                        default=1,
+                        help="Number of processes for --stats or --hist on an uncompressed file [1]")
     parser.add_argument("-o", "--outfile",
                         type=str,
                         default=sys.stdout,
@@ -77,8 +224,15 @@ if __name__ == "__main__":
     args = get_args()
     if args.reads == "-":
         args.reads = "/dev/stdin"
-    if args.hist:
-        lengths = get_readlengths(args.reads, print_lengths=False)
-        print_histogram(lengths, args.bin_width, args.outfile)
+    if args.reads == "/dev/stdin":
+        check_input(sys.stdin)
+    outfile = args.outfile if args.outfile is sys.stdout else open(args.outfile, "w")
+    if args.stats:
+        quantiles = [float(q) for q in args.quantiles.split(",") if q]
+        print_stats(get_length_stats(args.reads, args.num_processes), outfile, args.genome_size, quantiles)
+    elif args.hist:
+        print_histogram(get_length_histogram(args.reads, args.bin_width, args.num_processes), outfile)
     else:
-        get_readlengths(args.reads, outfile=args.outfile)
+        get_readlengths(args.reads, outfile=outfile)
+    if outfile is not sys.stdout:
+        outfile.close()
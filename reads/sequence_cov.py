@@ -1,26 +1,102 @@
 #!/usr/bin/env python3
-"""Compute sequence coverage for a genome sequencing read file."""
+"""
+Compute sequence coverage for one or more genome sequencing read files. Multiple files
+are counted in parallel worker processes and reported per file and in total.
+"""
 
 import sys
+import re
 import argparse
+import operator
+from multiprocessing import Pool
+from utils import map_reduce_reads, open_reads
+
+CHUNK_SIZE = 1 << 22
+HEADER_RE = re.compile(rb"^>[^\r\n]*", re.M)
+
+def count_fastq_bases(fh, buf):
+    """Returns the number of bases in a 4-line fastq stream, starting with the bytes in buf."""
+    sum_bases = 0
+    line_no = 0  # Line of the record that the next line in buf belongs to
+    rest = b""
+    while buf:
+        lines = (rest + buf).split(b"\n")
+        rest = lines.pop()
+        seqs = lines[(1 - line_no) % 4::4]
+        sum_bases += sum(map(len, seqs))
+        if b"\r" in buf:
+            sum_bases -= sum(seq.endswith(b"\r") for seq in seqs)
+        line_no = (line_no + len(lines)) % 4
+        buf = fh.read(CHUNK_SIZE)
+    if rest.rstrip(b"\r") and line_no == 1:
+        sum_bases += len(rest.rstrip(b"\r"))
+    return sum_bases
+
+
+def count_fasta_bases(fh, buf):
+    """Returns the number of bases in a (multi-line) fasta stream, starting with the bytes in buf."""
+    sum_bases = 0
+    rest = b""
+    while buf:
+        buf = rest + buf
+        cut = buf.rfind(b"\n") + 1
+        body, rest = buf[:cut], buf[cut:]
+        sum_bases += len(body) - body.count(b"\n") - body.count(b"\r") \
+            - sum(map(len, HEADER_RE.findall(body)))
+        buf = fh.read(CHUNK_SIZE)
+    if rest and not rest.startswith(b">"):
+        sum_bases += len(rest.rstrip(b"\r"))
+    return sum_bases
+
+
+def count_bases(fh):
+    """
+    Returns the number of bases in a fasta or fastq stream, scanning it in large chunks.
+    Newlines are not counted, and fasta records may span multiple lines.
+    """
+    fh = getattr(fh, "buffer", fh)  # Accept text handles
+    buf = fh.read(CHUNK_SIZE)
+    if buf.lstrip()[:1] == b"@":
+        return count_fastq_bases(fh, buf)
+    return count_fasta_bases(fh, buf)
+
+
+def count_file_bases(read_file):
+    """Returns the number of bases in a read file. Run by the worker processes."""
+    with open_reads(read_file) as fh:
+        return count_bases(fh)
+
 
 def calculate_cov(fh, genome_size, outfile):
     """Calculate the sequence coverage of a given file."""
-    line = fh.readline()
-    sum_bases = 0
+    sum_bases = count_bases(fh)
+    outfile.write(str(sum_bases / genome_size) + "\n")
+
+
+def count_batch_bases(batch):
+    """Returns the number of bases in a FastxBatch."""
+    return int(batch.offsets[-1])
 
-    if line[0] == "@":  # Fastq
-        for i, line in enumerate(fh):
-            if i % 4 == 0:
-                sum_bases += len(line)
-    elif line[0] == ">":  #Fasta
-        for i, line in enumerate(fh):
-            if i % 2 == 0:
-                sum_bases += len(line)
-    
+
+def calculate_cov_parallel(read_file, genome_size, outfile, num_processes):
+    """Calculate the sequence coverage of a read file, parsing it in num_processes shards."""
+    sum_bases = map_reduce_reads(read_file, count_batch_bases, operator.add, num_processes) or 0
     outfile.write(str(sum_bases / genome_size) + "\n")
 
 
+def calculate_cov_files(read_files, genome_size, outfile, num_processes):
+    """
+    Calculate the sequence coverage of several read files, counting num_processes files
+    at a time. Prints a tsv of the bases and coverage of each file and the total.
+    """
+    with Pool(max(1, min(num_processes, len(read_files)))) as pool:
+        file_bases = pool.map(count_file_bases, read_files, chunksize=1)
+    print("file", "bases", "coverage", sep="\t", file=outfile)
+    for read_file, sum_bases in zip(read_files, file_bases):
+        print(read_file, sum_bases, sum_bases / genome_size, sep="\t", file=outfile)
+    print("total", sum(file_bases), sum(file_bases) / genome_size, sep="\t", file=outfile)
+
+
 def get_gsize(size_string):
     """Get genome size from a string"""
     try:
@@ -33,9 +109,11 @@ def get_args():
     """Parse the command-line arguments."""
     parser = argparse.ArgumentParser(description="Calculate the sequence coverage for a set of reads")
     parser.add_argument("-r", "--reads",
-                        type=argparse.FileType("r"),
-                        default=sys.stdin,
-                        help="Read file [stdin]")
+                        type=str,
+                        nargs="+",
+                        default=["-"],
+                        help="Read file(s), plain, gzip or BGZF; coverage is reported per file "
+                             "and in total if several are given [stdin]")
     parser.add_argument("-g", "--gsize",
                         type=str,
                         required=True,
@@ -44,12 +122,23 @@ def get_args():
                         type=argparse.FileType("w"),
                         default=sys.stdout,
                         help="File to print sequence coverage to [stdout]")
+    parser.add_argument("-n", "--num_processes",
+                        type=int,
+                        default=1,
+                        help="Number of processes to parse the read file with, or number of "
+                             "files to count at once if several are given [1]")
     return parser.parse_args()
 
 
 def main():
     args = get_args()
-    calculate_cov(args.reads, get_gsize(args.gsize), args.outfile)
+    if len(args.reads) > 1:
+        calculate_cov_files(args.reads, get_gsize(args.gsize), args.outfile, args.num_processes)
+    elif args.num_processes > 1:
+        calculate_cov_parallel(args.reads[0], get_gsize(args.gsize), args.outfile, args.num_processes)
+    else:
+        with open_reads(args.reads[0]) as reads:
+            calculate_cov(reads, get_gsize(args.gsize), args.outfile)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Sort an interleaved linked reads fastq file by barcode (BX tag) with bounded memory.
+Sorted runs are spilled to temporary files and merged with a k-way heap merge. The sort
+is stable, so read pairs stay together and in their original order within a barcode.
+Reads without a BX tag are written last.
+"""
+
+import argparse
+import heapq
+import os
+import re
+import sys
+import tempfile
+from utils import open_reads, open_bgzf_writer
+from utils.read_fasta import iter_lines
+
+BX_RE = re.compile(rb"\sBX:Z:(\S+)")
+MAX_OPEN_RUNS = 64
+RECORD_OVERHEAD = 120  # Approximate bytes of Python object overhead per record
+
+def record_key(header):
+    """Returns the sort key for a fastq header line: barcoded reads first, by BX tag."""
+    search = BX_RE.search(header)
+    return (0, search.group(1)) if search else (1, b"")
+
+
+def read_records(fh):
+    """Yields (key, record) tuples for the 4-line fastq records in a binary file handle."""
+    lines = iter_lines(fh)
+    for header in lines:
+        if not header:
+            continue
+        record = b"\n".join((header, next(lines, b""), next(lines, b""), next(lines, b""))) + b"\n"
+        yield record_key(header), record
+
+
+def write_run(records, tmp_dir):
+    """Sort records by key (stable) and write them to a temporary file. Returns its name."""
+    records.sort(key=lambda r: r[0])
+    fd, name = tempfile.mkstemp(suffix=".fastq", dir=tmp_dir)
+    with os.fdopen(fd, "wb") as run:
+        for _, record in records:
+            run.write(record)
+    return name
+
+
+def merge_runs(runs, outfile):
+    """Merge sorted run files into the binary handle outfile and delete the runs."""
+    handles = [open(run, "rb") for run in runs]
+    try:
+        # heapq.merge takes equal keys from earlier runs first, which keeps the sort stable
+        for _, record in heapq.merge(*[read_records(fh) for fh in handles], key=lambda r: r[0]):
+            outfile.write(record)
+    finally:
+        for fh, run in zip(handles, runs):
+            fh.close()
+            os.remove(run)
+
+
+def make_runs(read_file, max_memory, tmp_dir):
+    """Split read_file into sorted runs holding at most about max_memory bytes each."""
+    runs = []
+    records = []
+    used = 0
+    with open_reads(read_file) as fh:
+        for key, record in read_records(fh):
+            records.append((key, record))
+            used += len(record) + RECORD_OVERHEAD
+            if used >= max_memory:
+                runs.append(write_run(records, tmp_dir))
+                records = []
+                used = 0
+    if records or not runs:
+        runs.append(write_run(records, tmp_dir))
+    return runs
+
+
+def sort_reads(read_file, outfile, max_memory, tmp_dir=None):
+    """Sort read_file by BX tag and write the sorted reads to the binary handle outfile."""
+    runs = make_runs(read_file, max_memory, tmp_dir)
+    # Merge in passes if there are too many runs to keep open at once
+    while len(runs) > MAX_OPEN_RUNS:
+        merged = []
+        for i in range(0, len(runs), MAX_OPEN_RUNS):
+            fd, name = tempfile.mkstemp(suffix=".fastq", dir=tmp_dir)
+            with os.fdopen(fd, "wb") as run:
+                merge_runs(runs[i:i + MAX_OPEN_RUNS], run)
+            merged.append(name)
+        runs = merged
+    merge_runs(runs, outfile)
+
+
+def get_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Sort an interleaved linked reads fastq file by barcode")
+    parser.add_argument("-r", "--reads",
+                        type=str,
+                        default="-",
+                        help="Read file, plain, gzip or BGZF [stdin]")
+    parser.add_argument("-o", "--outfile",
+                        type=str,
+                        default="-",
+                        help="Output file [stdout]")
+    parser.add_argument("-m", "--max_memory",
+                        type=int,
+                        default=2048,
+                        help="Approximate memory for each sorted run, in MB [2048]")
+    parser.add_argument("-T", "--tmp_dir",
+                        type=str,
+                        default=None,
+                        help="Directory for temporary run files [system default]")
+    parser.add_argument("-z", "--compress",
+                        action="store_true",
+                        help="Write output in BGZF (gzip-compatible) format")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.compress:
+        outfile = open_bgzf_writer(args.outfile)
+    elif args.outfile == "-":
+        outfile = sys.stdout.buffer
+    else:
+        outfile = open(args.outfile, "wb")
+    sort_reads(args.reads, outfile, args.max_memory * (1 << 20), args.tmp_dir)
+    if outfile is sys.stdout.buffer:
+        outfile.flush()
+    else:
+        outfile.close()
+
+
+if __name__ == "__main__":
+    main()
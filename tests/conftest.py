@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Scripts import utils from the repository root (as when run with PYTHONPATH set to it)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from utils import open_reads
+from utils.kmers import CountMinSketch, KmerCounter, merge_counts
+from fasta.cov_vs_gc import count_kmers, count_kmers_approx, count_kmer_coverage
+
+
+def random_kmers(num_kmers, words, seed=0):
+    """Returns num_kmers distinct random (kmers, words) k-mers with random counts."""
+    rng = np.random.default_rng(seed)
+    kmers = np.unique(rng.integers(0, 1 << 62, size=(num_kmers, words), dtype=np.uint64), axis=0)
+    counts = rng.geometric(0.3, size=len(kmers)).astype(np.int64)
+    return kmers, counts
+
+
+def write_fastq(path, num_reads=2000, read_length=100, genome_length=5000, seed=0):
+    """Write reads sampled from a random genome (with a few N bases) to path."""
+    rng = np.random.default_rng(seed)
+    genome = rng.choice(list(b"ACGT"), size=genome_length).astype(np.uint8)
+    genome[rng.choice(genome_length, size=10, replace=False)] = ord("N")
+    with open(path, "w") as fh:
+        for i, start in enumerate(rng.integers(0, genome_length - read_length, size=num_reads).tolist()):
+            seq = genome[start:start + read_length].tobytes().decode()
+            fh.write("@r{0}\n{1}\n+\n{2}\n".format(i, seq, "I" * read_length))
+
+
+@pytest.mark.parametrize("canonical", [False, True])
+@pytest.mark.parametrize("k", [1, 5, 31, 32, 33, 64, 70])
+def test_count_kmers_matches_string_counter(tmp_path, k, canonical):
+    reads = str(tmp_path / "reads.fq")
+    write_fastq(reads, num_reads=200)
+    with open_reads(reads) as fh:
+        counts = count_kmers(fh, k, canonical).to_dict()
+    for fast in (False, True):
+        with open_reads(reads, text=not fast) as fh:
+            string_counts = count_kmer_coverage(fh, k, fast, canonical)
+        # The 2-bit counter skips k-mers with non-ACGT bases
+        assert counts == {kmer: count for kmer, count in string_counts.items() if "N" not in kmer}
+
+
+def test_sketch_never_underestimates():
+    kmers, counts = random_kmers(20000, 2)
+    sketch = CountMinSketch(1 << 10, depth=4)
+    for start in range(0, len(kmers), 3000):  # Add in batches, as count_kmers_approx does
+        sketch.add(kmers[start:start + 3000], counts[start:start + 3000])
+    assert sketch.total == counts.sum()
+    assert (sketch.query(kmers) >= counts).all()
+
+
+def test_sketch_overestimate_within_error_bound():
+    kmers, counts = random_kmers(20000, 1, seed=1)
+    sketch = CountMinSketch(1 << 12, depth=4)
+    sketch.add(kmers, counts)
+    over = sketch.query(kmers) - counts
+    assert over.max() > 0  # The sketch is small enough to have collisions
+    assert np.mean(over > sketch.error_bound()) <= np.exp(-sketch.depth)
+
+
+@pytest.mark.parametrize("memory", [1 << 12, 1 << 16, 1 << 22])
+@pytest.mark.parametrize("k,canonical", [(21, False), (31, True), (45, True)])
+def test_approx_matches_exact_above_threshold(tmp_path, memory, k, canonical):
+    reads = str(tmp_path / "reads.fq")
+    write_fastq(reads)
+    threshold = 3
+    with open_reads(reads) as fh:
+        exact = count_kmers(fh, k, canonical).filter(threshold)
+    approx, sketch = count_kmers_approx(reads, k, canonical, memory, threshold)
+    exact_kmers, exact_counts = exact.kmers()
+    approx_kmers, approx_counts = approx.kmers()
+    assert len(exact) > 0
+    assert np.array_equal(approx_kmers, exact_kmers)
+    assert np.array_equal(approx_counts, exact_counts)
+
+
+def test_counter_filter():
+    counter = KmerCounter(5)
+    keys, counts = merge_counts(np.array([3, 1, 3, 2, 3, 1], dtype=np.uint64), np.ones(6, dtype=np.int64))
+    counter.add_counts(keys, counts)
+    kmers, counts = counter.filter(2).kmers()
+    assert kmers[:, 0].tolist() == [1, 3]
+    assert counts.tolist() == [2, 3]
@@ -1,3 +1,7 @@
-from .read_fasta import read_fasta
-from .print_histogram import print_histogram
-from .gc_content import calc_gc
\ No newline at end of file
+from .read_fasta import read_fasta, read_fasta_bytes, read_fasta_batches, FastxBatch
+from .print_histogram import print_histogram, StreamingHistogram
+from .gc_content import calc_gc
+from .parallel_reads import map_reduce_reads
+from .open_reads import open_reads
+from .bgzf import open_bgzf_writer
+from .bx_index import BxIndex
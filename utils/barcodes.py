@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Pack 10x barcodes into integers, count them with NumPy and correct them against a
+whitelist. The 16 bp barcode sequence is stored 2 bits per base in the low 32 bits and
+the GEM group suffix (e.g. the 1 in AAACCTGAGAAACCAT-1) in the upper 32 bits. A barcode
+without a suffix has GEM group 0.
+"""
+
+import numpy as np
+from utils.open_reads import open_reads
+
+BARCODE_LENGTH = 16
+MERGE_SIZE = 1 << 20
+BASES = b"ACGT"
+
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(BASES):
+    BASE_CODES[base] = code
+SHIFTS = np.arange(2 * (BARCODE_LENGTH - 1), -1, -2, dtype=np.uint64)
+SEQ_MASK = np.uint64(0xffffffff)
+
+
+def encode_barcodes(bxs):
+    """
+    Encode a list of barcode tags (bytes or str). Returns a tuple (codes, valid) of a
+    uint64 array of codes and a boolean array, False for tags that could not be encoded
+    (wrong length, non-ACGT bases or a malformed suffix).
+    """
+    n = len(bxs)
+    if n == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    arr = np.array([bx.encode() if isinstance(bx, str) else bx for bx in bxs], dtype=bytes)
+    width = arr.dtype.itemsize
+    if width < BARCODE_LENGTH:
+        return np.zeros(n, dtype=np.uint64), np.zeros(n, dtype=bool)
+    mat = arr.view(np.uint8).reshape(n, width)
+
+    base = BASE_CODES[mat[:, :BARCODE_LENGTH]]
+    valid = (base < 4).all(axis=1)
+    seq = (base.astype(np.uint64) << SHIFTS).sum(axis=1, dtype=np.uint64)
+
+    gem = np.zeros(n, dtype=np.uint64)
+    if width > BARCODE_LENGTH:
+        has_suffix = mat[:, BARCODE_LENGTH] != 0
+        digits = mat[:, BARCODE_LENGTH + 1:]
+        present = digits != 0
+        is_digit = (digits >= ord("0")) & (digits <= ord("9"))
+        for j in range(digits.shape[1]):
+            gem = np.where(present[:, j], gem * 10 + (digits[:, j] - ord("0")), gem)
+        suffix_ok = (mat[:, BARCODE_LENGTH] == ord("-")) & (~present | is_digit).all(axis=1) \
+            & (gem > 0) & (gem < (1 << 32))
+        valid &= ~has_suffix | suffix_ok
+    codes = (gem << np.uint64(32)) | seq
+    codes[~valid] = 0
+    return codes, valid
+
+
+def encode_barcode(bx):
+    """Encode a single barcode tag. Returns None if it cannot be encoded."""
+    codes, valid = encode_barcodes([bx])
+    return int(codes[0]) if valid[0] else None
+
+
+def decode_barcode(code):
+    """Decode a barcode code back to its tag string."""
+    code = int(code)
+    seq = "".join("ACGT"[(code >> shift) & 3] for shift in range(2 * (BARCODE_LENGTH - 1), -1, -2))
+    gem = code >> 32
+    return "{0}-{1}".format(seq, gem) if gem else seq
+
+
+def decode_barcodes(codes):
+    """Decode an array of barcode codes. Returns a list of tags (bytes)."""
+    codes = np.asarray(codes, dtype=np.uint64)
+    if len(codes) == 0:
+        return []
+    bases = ((codes[:, None] >> SHIFTS) & np.uint64(3)).astype(np.uint8)
+    seqs = np.frombuffer(BASES, dtype=np.uint8)[bases].view("S{0}".format(BARCODE_LENGTH)).ravel().tolist()
+    gems = (codes >> np.uint64(32)).tolist()
+    return [seq + b"-%d" % gem if gem else seq for seq, gem in zip(seqs, gems)]
+
+
+def merge_code_counts(codes, counts):
+    """Sum the counts of duplicate codes. Returns a tuple (sorted unique codes, counts)."""
+    uniq, inverse = np.unique(codes, return_inverse=True)
+    merged = np.zeros(len(uniq), dtype=np.int64)
+    np.add.at(merged, inverse.ravel(), counts)
+    return uniq, merged
+
+
+class BarcodeCounter:
+    """
+    Counts barcode tags. Encoded barcodes are counted per batch with np.unique and the
+    partial counts merged once they outgrow the merged table; tags that cannot be
+    encoded are counted in a dict. Counters can be merged with update.
+    """
+    def __init__(self):
+        self.codes = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_size = 0
+        self.other = {}
+
+    def add(self, bxs):
+        """Count a list of barcode tags (None entries are skipped)."""
+        bxs = [bx for bx in bxs if bx is not None]
+        codes, valid = encode_barcodes(bxs)
+        uniq, counts = np.unique(codes[valid], return_counts=True)
+        self.add_counts(uniq, counts)
+        for i in np.flatnonzero(~valid):
+            self.other[bxs[i]] = self.other.get(bxs[i], 0) + 1
+        return self
+
+    def add_counts(self, codes, counts):
+        """Add counts for an array of codes."""
+        self.pending.append((codes, counts.astype(np.int64)))
+        self.pending_size += len(codes)
+        if self.pending_size > max(len(self.codes), MERGE_SIZE):
+            self.merge()
+
+    def merge(self):
+        """Merge pending partial counts into the count table."""
+        if self.pending:
+            codes = np.concatenate([self.codes] + [c for c, _ in self.pending])
+            counts = np.concatenate([self.counts] + [n for _, n in self.pending])
+            self.codes, self.counts = merge_code_counts(codes, counts)
+            self.pending = []
+            self.pending_size = 0
+
+    def update(self, other):
+        """Add the counts of another BarcodeCounter and return self."""
+        other.merge()
+        self.add_counts(other.codes, other.counts)
+        for bx, count in other.other.items():
+            self.other[bx] = self.other.get(bx, 0) + count
+        return self
+
+    def multiplicities(self):
+        """Returns an int64 array with the number of reads of every barcode."""
+        self.merge()
+        return np.concatenate([self.counts, np.array(list(self.other.values()), dtype=np.int64)])
+
+    def to_dict(self):
+        """Returns a dictionary of barcode tag -> count."""
+        self.merge()
+        bxs = {decode_barcode(code): count for code, count in zip(self.codes.tolist(), self.counts.tolist())}
+        for bx, count in self.other.items():
+            bxs[bx.decode() if isinstance(bx, bytes) else bx] = count
+        return bxs
+
+
+class BarcodeWhitelist:
+    """
+    Whitelist of barcode sequences (e.g. the 10x 4M-with-alts list) with a precomputed
+    Hamming distance 1 neighbour index. Every neighbour of every whitelisted barcode is
+    stored as a sorted uint32 key with the index of its whitelisted barcode, or -1 if the
+    neighbour is one mismatch from more than one whitelisted barcode. The index holds
+    48 entries per whitelisted barcode (about 1.7 GB for 4.7M barcodes).
+    """
+    def __init__(self, barcodes):
+        codes, valid = encode_barcodes(barcodes)
+        self.codes = np.unique((codes[valid] & SEQ_MASK).astype(np.uint32))
+        self.build_neighbours()
+
+    @classmethod
+    def load(cls, filename):
+        """Load a whitelist file with one barcode per line (plain or gzip)."""
+        with open_reads(filename) as fh:
+            return cls(fh.read().split())
+
+    def __len__(self):
+        return len(self.codes)
+
+    def build_neighbours(self):
+        """Build the sorted Hamming distance 1 neighbour index."""
+        n = len(self.codes)
+        index = np.arange(n, dtype=np.uint64)
+        packed = np.empty(n * 3 * BARCODE_LENGTH, dtype=np.uint64)
+        i = 0
+        for shift in range(0, 2 * BARCODE_LENGTH, 2):
+            for delta in (1, 2, 3):  # XOR with 1-3 gives the three other bases
+                neighbours = self.codes ^ np.uint32(delta << shift)
+                packed[i * n:(i + 1) * n] = (neighbours.astype(np.uint64) << np.uint64(32)) | index
+                i += 1
+        packed.sort()
+        keys = (packed >> np.uint64(32)).astype(np.uint32)
+        targets = (packed & SEQ_MASK).astype(np.int32)
+        del packed
+        same = keys[1:] == keys[:-1]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = ~same
+        ambiguous = np.zeros(len(keys), dtype=bool)
+        ambiguous[1:] |= same
+        ambiguous[:-1] |= same
+        targets[ambiguous] = -1
+        self.neighbour_keys = keys[first]
+        self.neighbour_targets = targets[first]
+
+    def correct(self, seqs):
+        """
+        Correct an array of uint32 barcode sequence codes. Returns a tuple (corrected
+        codes, ok) where ok is False for barcodes that are neither whitelisted nor one
+        mismatch from exactly one whitelisted barcode.
+        """
+        seqs = np.asarray(seqs, dtype=np.uint32)
+        corrected = seqs.copy()
+        if len(self.codes) == 0:
+            return corrected, np.zeros(len(seqs), dtype=bool)
+        pos = np.searchsorted(self.codes, seqs)
+        pos[pos == len(self.codes)] = 0
+        ok = self.codes[pos] == seqs
+        rest = np.flatnonzero(~ok)
+        if len(rest):
+            query = seqs[rest]
+            pos = np.searchsorted(self.neighbour_keys, query)
+            pos[pos == len(self.neighbour_keys)] = 0
+            targets = self.neighbour_targets[pos]
+            hit = (self.neighbour_keys[pos] == query) & (targets >= 0)
+            corrected[rest[hit]] = self.codes[targets[hit]]
+            ok[rest[hit]] = True
+        return corrected, ok
+
+    def correct_n(self, bx):
+        """
+        Correct a tag with a single N in the barcode sequence if exactly one base at that
+        position gives a whitelisted barcode. Returns the corrected tag (bytes) or None.
+        """
+        if bx[:BARCODE_LENGTH].count(b"N") != 1:
+            return None
+        candidates = [bx.replace(b"N", base, 1) for base in (b"A", b"C", b"G", b"T")]
+        codes, valid = encode_barcodes(candidates)
+        pos = np.searchsorted(self.codes, (codes & SEQ_MASK).astype(np.uint32))
+        pos[pos == len(self.codes)] = 0
+        found = valid & (self.codes[pos] == (codes & SEQ_MASK).astype(np.uint32))
+        if found.sum() != 1:
+            return None
+        return candidates[int(np.flatnonzero(found)[0])]
+
+    def correct_tags(self, bxs):
+        """
+        Correct a list of barcode tags (bytes), keeping their GEM group suffix. Returns a
+        list with the corrected tag, or None for tags that cannot be corrected.
+        """
+        if not bxs or len(self.codes) == 0:
+            return [None] * len(bxs)
+        codes, valid = encode_barcodes(bxs)
+        corrected, ok = self.correct((codes & SEQ_MASK).astype(np.uint32))
+        ok &= valid
+        tags = decode_barcodes((codes & ~SEQ_MASK) | corrected.astype(np.uint64))
+        tags = [tag if good else None for tag, good in zip(tags, ok.tolist())]
+        for i in np.flatnonzero(~valid).tolist():
+            tags[i] = self.correct_n(bxs[i])
+        return tags
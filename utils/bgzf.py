@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Read and write BGZF (blocked gzip) files, (de)compressing blocks in a background
+thread pool. See section 4.1 of the SAM specification for the format.
+"""
+
+import io
+import os
+import struct
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_THREADS = min(4, os.cpu_count() or 1)
+BGZF_HEADER = struct.Struct("<4BI2BH")  # ID1 ID2 CM FLG MTIME XFL OS XLEN
+BGZF_TRAILER = struct.Struct("<2I")  # CRC32 ISIZE
+BLOCK_DATA_SIZE = 0xff00  # Max uncompressed bytes per block, as in htslib
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+BLOCK_HISTORY = 64  # Recent blocks kept for virtual offset lookups
+
+def is_bgzf(header):
+    """Returns True if header (the first bytes of a file) is the start of a BGZF block."""
+    if len(header) < 16 or header[:4] != b"\x1f\x8b\x08\x04":
+        return False
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = header[12:12 + xlen]
+    return extra[:4] == b"BC\x02\x00"
+
+
+def read_block(fh):
+    """
+    Read the next BGZF block from fh. Returns a tuple (compressed data, crc32, size),
+    or None at end of file.
+    """
+    header = fh.read(BGZF_HEADER.size)
+    if not header:
+        return None
+    if len(header) < BGZF_HEADER.size:
+        raise EOFError("truncated BGZF block header")
+    id1, id2, _, flag, _, _, _, xlen = BGZF_HEADER.unpack(header)
+    if id1 != 0x1f or id2 != 0x8b or not flag & 4:
+        raise ValueError("input is not in BGZF format")
+    extra = fh.read(xlen)
+    bsize = None
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack("<H", extra[i + 2:i + 4])[0]
+        if extra[i:i + 2] == b"BC" and slen == 2:
+            bsize = struct.unpack("<H", extra[i + 4:i + 6])[0]
+        i += 4 + slen
+    if bsize is None:
+        raise ValueError("gzip block is missing the BGZF block size field")
+    rest = fh.read(bsize + 1 - BGZF_HEADER.size - xlen)
+    if len(rest) < BGZF_TRAILER.size:
+        raise EOFError("truncated BGZF block")
+    crc, size = BGZF_TRAILER.unpack(rest[-BGZF_TRAILER.size:])
+    return rest[:-BGZF_TRAILER.size], crc, size
+
+
+def inflate_block(cdata, crc, size):
+    """Decompress the deflate data of a BGZF block and check its length and CRC."""
+    data = zlib.decompress(cdata, -15)
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise OSError("BGZF block failed CRC/length check")
+    return data
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Raw binary stream over a BGZF file. Blocks are read ahead on the calling thread and
+    decompressed in a pool of threads (zlib releases the GIL), then returned in order.
+    Wrap in io.BufferedReader for efficient small reads. The reader remembers where
+    recent blocks start, so uncompressed offsets near the current position can be
+    converted to BGZF virtual offsets (compressed block offset << 16 | offset in block).
+    """
+    def __init__(self, fileobj, threads=DEFAULT_THREADS, lookahead=None):
+        self.fileobj = fileobj
+        self.pool = ThreadPoolExecutor(max(1, threads))
+        self.lookahead = lookahead or max(1, threads) * 4
+        self.pending = deque()
+        self.eof = False
+        self.block = b""
+        self.pos = 0
+        self.ustart = 0  # Uncompressed offset of the start of the current block
+        self.blocks = deque(maxlen=BLOCK_HISTORY)
+
+    def readable(self):
+        return True
+
+    def fill(self):
+        """Submit blocks for decompression until lookahead blocks are pending."""
+        while not self.eof and len(self.pending) < self.lookahead:
+            try:
+                coffset = self.fileobj.tell()
+            except (OSError, ValueError):  # Not seekable, e.g. a pipe
+                coffset = None
+            block = read_block(self.fileobj)
+            if block is None:
+                self.eof = True
+            else:
+                self.pending.append((coffset, self.pool.submit(inflate_block, *block)))
+
+    def next_block(self):
+        """Make the next decompressed block current. Returns False at end of file."""
+        self.fill()
+        if not self.pending:
+            return False
+        self.ustart += len(self.block)
+        coffset, future = self.pending.popleft()
+        self.block = future.result()
+        self.pos = 0
+        self.blocks.append((self.ustart, coffset, len(self.block)))
+        return True
+
+    def readinto(self, b):
+        while self.pos >= len(self.block):
+            if not self.next_block():
+                return 0
+        n = min(len(b), len(self.block) - self.pos)
+        b[:n] = self.block[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def virtual_offset(self, uoffset):
+        """
+        Returns the virtual offset of the uncompressed offset uoffset, or None if it is
+        not in a recently read block or the file is not seekable.
+        """
+        for ustart, coffset, length in reversed(self.blocks):
+            if coffset is not None and ustart <= uoffset <= ustart + length:
+                return (coffset << 16) | (uoffset - ustart)
+        return None
+
+    def seek_virtual(self, voffset, uoffset=0):
+        """
+        Continue reading from the virtual offset voffset. uoffset is the uncompressed
+        offset it corresponds to, used for later virtual_offset lookups.
+        """
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.blocks.clear()
+        self.fileobj.seek(voffset >> 16)
+        self.eof = False
+        self.block = b""
+        self.ustart = uoffset - (voffset & 0xffff)
+        self.next_block()
+        self.pos = voffset & 0xffff
+
+    def close(self):
+        if not self.closed:
+            for _, future in self.pending:
+                future.cancel()
+            self.pool.shutdown(wait=True)
+            self.fileobj.close()
+        super().close()
+
+
+def deflate_block(data, level):
+    """Compress data into a complete BGZF block."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    bsize = BGZF_HEADER.size + 6 + len(cdata) + BGZF_TRAILER.size - 1
+    return b"".join((BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6),
+                     struct.pack("<2s2H", b"BC", 2, bsize),
+                     cdata,
+                     BGZF_TRAILER.pack(zlib.crc32(data), len(data))))
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    Binary stream that writes BGZF to fileobj. Data is accumulated into blocks that are
+    compressed in a pool of threads and written in order. Closing the writer flushes the
+    last block, writes the BGZF EOF marker and closes fileobj if close_fileobj is True.
+    Several writers can share an executor passed as pool; it is not shut down on close.
+    """
+    def __init__(self, fileobj, threads=DEFAULT_THREADS, level=6, close_fileobj=True, lookahead=None,
+                 pool=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.close_fileobj = close_fileobj
+        self.own_pool = pool is None
+        self.pool = ThreadPoolExecutor(max(1, threads)) if pool is None else pool
+        self.lookahead = lookahead or max(1, threads) * 4
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.finished = False
+
+    def writable(self):
+        return True
+
+    def submit(self, data):
+        """Queue data for compression, writing finished blocks once enough are pending."""
+        self.pending.append(self.pool.submit(deflate_block, data, self.level))
+        while len(self.pending) > self.lookahead:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, b):
+        self.buffer += b
+        if len(self.buffer) >= BLOCK_DATA_SIZE:
+            view = memoryview(self.buffer)
+            start = 0
+            while len(self.buffer) - start >= BLOCK_DATA_SIZE:
+                self.submit(bytes(view[start:start + BLOCK_DATA_SIZE]))
+                start += BLOCK_DATA_SIZE
+            view.release()
+            del self.buffer[:start]
+        return len(b)
+
+    def flush(self):
+        """Compress any buffered data and write all pending blocks."""
+        if self.closed or self.finished:
+            return
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.fileobj.flush()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.fileobj.write(BGZF_EOF)
+            self.fileobj.flush()
+            if self.own_pool:
+                self.pool.shutdown(wait=True)
+            self.finished = True
+            if self.close_fileobj:
+                self.fileobj.close()
+        super().close()
+
+
+def open_bgzf_writer(filename, text=False, threads=DEFAULT_THREADS, level=6, pool=None):
+    """
+    Open filename ('-' for stdout) for writing BGZF. Returns a binary stream, or a text
+    stream if text is True.
+    """
+    if filename == "-" or filename is sys.stdout:
+        writer = BgzfWriter(sys.stdout.buffer, threads, level, close_fileobj=False, pool=pool)
+    else:
+        writer = BgzfWriter(open(filename, "wb"), threads, level, pool=pool)
+    if text:
+        return io.TextIOWrapper(writer)
+    return writer
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Build or load a barcode multiplicity index for a longranger basic-processed reads file.
+The index stores, for each barcode (in file order), its read count and the range of its
+header hashes, so any multiplicity window can be selected without rescanning the reads.
+"""
+
+import argparse
+import array
+import sys
+import numpy as np
+from utils.open_reads import open_reads
+from utils.header_set import hash_header
+
+class BxIndex:
+    def __init__(self, barcodes, counts, offsets, hashes):
+        """
+        barcodes: array of barcode tags (bytes), counts: reads per barcode, offsets:
+        start of each barcode's header hashes in hashes (with a final end offset).
+        """
+        self.barcodes = barcodes
+        self.counts = counts
+        self.offsets = offsets
+        self.hashes = hashes
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index written by save."""
+        with np.load(filename) as index:
+            return cls(index["barcodes"], index["counts"], index["offsets"], index["hashes"])
+
+    def save(self, filename):
+        """Save the index as an uncompressed .npz file."""
+        with open(filename, "wb") as fh:
+            np.savez(fh, barcodes=self.barcodes, counts=self.counts,
+                     offsets=self.offsets, hashes=self.hashes)
+
+    def select(self, min_reads, max_reads):
+        """
+        Select barcodes with at least min_reads and at most max_reads reads. Returns the
+        same tuple as filter_bx.get_bx: (dict of bx -> (start, end) range in the hash
+        array, uint64 array of header hashes, None).
+        """
+        idx = np.flatnonzero((self.counts >= min_reads) & (self.counts <= max_reads))
+        starts = self.offsets[idx]
+        lengths = self.offsets[idx + 1] - starts
+        new_offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+        gather = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+        hashes = self.hashes[gather]
+
+        valid_bx = {}
+        for bx, start, end in zip(self.barcodes[idx].tolist(), new_offsets[:-1].tolist(),
+                                  new_offsets[1:].tolist()):
+            valid_bx[bx.decode()] = (start, end)
+        return valid_bx, hashes, None
+
+
+def build_bx_index(read_file):
+    """
+    Scan a barcoded reads file (grouped by barcode, e.g. with reads/sort_bx.py) and
+    return a BxIndex. Consecutive reads with the same barcode are counted together,
+    as in filter_bx.get_bx.
+    """
+    barcodes = []
+    counts = array.array("q")
+    offsets = array.array("q", [0])
+    hashes = array.array("Q")
+    prev_bx = None
+    cur_headers = set()
+    cur_reads = 0
+
+    def add_bx():
+        barcodes.append(prev_bx.encode())
+        counts.append(cur_reads)
+        hashes.extend(sorted(cur_headers))
+        offsets.append(len(hashes))
+
+    with open_reads(read_file, text=True) as fh:
+        for i, line in enumerate(fh):
+            if i % 4 == 0:  # Header line
+                line_split = line.split(" ")
+                if len(line_split) > 1:  # Read has a bx
+                    bx = line_split[1].strip()
+                    if bx != prev_bx:
+                        if prev_bx is not None:
+                            add_bx()
+                        prev_bx = bx
+                        cur_headers = set()
+                        cur_reads = 0
+                    cur_reads += 1
+                    cur_headers.add(hash_header(line_split[0]))
+    if prev_bx is not None:
+        add_bx()
+
+    return BxIndex(np.array(barcodes, dtype=bytes),
+                   np.frombuffer(counts, dtype=np.int64),
+                   np.frombuffer(offsets, dtype=np.int64),
+                   np.frombuffer(hashes, dtype=np.uint64))
+
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Build a barcode multiplicity index for a "
+                                     "longranger basic-processed reads file")
+    parser.add_argument("-b", "--barcoded_reads",
+                        type=str,
+                        default="-",
+                        help="File containing barcoded reads [stdin]")
+    parser.add_argument("-o", "--outfile",
+                        type=str,
+                        required=True,
+                        help="Output index file (.npz)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    index = build_bx_index(args.barcoded_reads)
+    index.save(args.outfile)
+    print("indexed {0} barcodes and {1} headers".format(len(index), len(index.hashes)),
+          file=sys.stderr, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,210 @@
 #!/usr/bin/env python3
 """
-Calculate gc content from a FASTA, FASTQ or BAM file.
+Calculate gc content from a FASTA, FASTQ or BAM file, globally, per sequence or in
+sliding windows along each sequence (bedGraph).
 """
 
 import argparse
 import os.path
 import sys
-import Bio.SeqIO
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
 import pysam
+from utils.read_fasta import read_fasta_batches, read_fasta_bytes
+from utils.parallel_reads import map_reduce_reads
+from utils.open_reads import open_reads
+
+def count_gc(sequence):
+    """Returns the number of G and C bases (upper or lower case) in a str or bytes sequence."""
+    if isinstance(sequence, str):
+        return sequence.count("G") + sequence.count("C") + sequence.count("g") + sequence.count("c")
+    return sequence.count(b"G") + sequence.count(b"C") + sequence.count(b"g") + sequence.count(b"c")
+
 
 def calc_gc(sequence):
-    """Given a DNA sequence, returns the GC content."""
-    if type(sequence) != str:
+    """Given a DNA sequence (str or bytes), returns the GC content."""
+    if not isinstance(sequence, (str, bytes)):
         raise ValueError("Input sequence must be a string")
-    
-    length = len(sequence)
-    gc = 0
+    return count_gc(sequence) / len(sequence)
 
-    for char in sequence.upper():
-        if char == "C" or char == "G":
-            gc += 1
-    
-    return gc / length
 
+def get_fastx_gc(filename):
+    """
+    Parses a FASTA/FASTQ file (file name or open handle) in batches. Yields a tuple
+    (names, gc counts, lengths) for each batch.
+    """
+    fh = open_reads(filename) if isinstance(filename, str) else filename
+    try:
+        for batch in read_fasta_batches(fh):
+            names = [name.decode() for name in batch.names]
+            yield names, batch.gc_counts().tolist(), batch.lengths().tolist()
+    finally:
+        if fh is not filename:
+            fh.close()
 
-def get_fastx_seqs(filename, format):
-    """Parses a FASTA/FASTQ file and returns a list of tuples (name, sequence)."""
-    if not (format == "fasta" or format == "fastq"):
-        raise ValueError("Format must be 'fasta' or 'fastq")
-    
-    seqs = []
-    with open(filename, "r") as fh:
-        for entry in Bio.SeqIO.parse(fh, format):
-            seqs.append((entry.id, str(entry.seq)))
-    
-    return seqs
 
+def batch_gc_totals(batch):
+    """Returns a tuple (gc count, length) summed over a FastxBatch."""
+    return int(batch.gc_counts().sum()), int(batch.offsets[-1])
 
-def get_aln_seqs(filename):
-    """Parses a SAM/BAM file and return a list of tuples (name, sequence)."""
-    seqs = []
-    aln_file = pysam.AlignmentFile(filename, check_sq=False)
 
-    for read in aln_file.fetch(until_eof=True):
-        seqs.append((read.query_name, read.query_sequence))
-    
-    return seqs
+def add_gc_totals(totals, other):
+    """Add two (gc count, length) tuples."""
+    return totals[0] + other[0], totals[1] + other[1]
+
+
+G_LOOKUP = np.zeros(256, dtype=np.uint8)
+G_LOOKUP[list(b"Gg")] = 1
+C_LOOKUP = np.zeros(256, dtype=np.uint8)
+C_LOOKUP[list(b"Cc")] = 1
+
+
+def window_bounds(length, window, step):
+    """
+    Returns arrays of the start and end of each window along a sequence of length.
+    Windows start every step bases until one reaches the end of the sequence; the last
+    window may be shorter than window.
+    """
+    num_windows = min(max(0, -(-(length - window) // step)) + 1, -(-length // step))
+    starts = np.arange(num_windows, dtype=np.int64) * step
+    return starts, np.minimum(starts + window, length)
+
+
+def window_counts(seq, starts, ends):
+    """
+    Returns arrays of the number of G and C bases in each window of seq (bytes). Counts
+    are summed between window boundaries and accumulated, so each window is the
+    difference of two cumulative counts.
+    """
+    bounds = np.unique(np.concatenate(([0], starts, ends)))
+    bounds = bounds[bounds < len(seq)]
+    bases = np.frombuffer(seq, dtype=np.uint8)
+    counts = []
+    for lookup in (G_LOOKUP, C_LOOKUP):
+        cumulative = np.zeros(len(bounds) + 1, dtype=np.int64)
+        np.cumsum(np.add.reduceat(lookup[bases], bounds, dtype=np.int64), out=cumulative[1:])
+        positions = np.append(bounds, len(seq))
+        counts.append(cumulative[np.searchsorted(positions, ends)] - cumulative[np.searchsorted(positions, starts)])
+    return counts
+
+
+def format_gc_windows(record, window, step, skew=False):
+    """
+    Returns bedGraph lines for the GC content (or GC skew, (G - C) / (G + C)) of the
+    windows along a (name, sequence) record of bytes.
+    """
+    name, seq = record
+    if not seq:
+        return ""
+    starts, ends = window_bounds(len(seq), window, step)
+    g, c = window_counts(seq, starts, ends)
+    if skew:
+        values = np.divide(g - c, g + c, out=np.zeros(len(g)), where=(g + c) > 0)
+    else:
+        values = (g + c) / (ends - starts)
+    name = name.decode()
+    return "".join("{0}\t{1}\t{2}\t{3:.6g}\n".format(name, start, end, value)
+                   for start, end, value in zip(starts.tolist(), ends.tolist(), values.tolist()))
+
+
+def write_gc_windows(filename, window, step, skew=False, num_processes=1, outfile=sys.stdout):
+    """
+    Write a bedGraph of windowed GC content (or skew) for each sequence in a FASTA/FASTQ
+    file. Sequences are processed by num_processes worker processes, in order.
+    """
+    format_record = partial(format_gc_windows, window=window, step=step, skew=skew)
+    with open_reads(filename) as fh:
+        records = ((name, seq) for name, seq, _, _ in read_fasta_bytes(fh))
+        if num_processes <= 1:
+            for record in records:
+                outfile.write(format_record(record))
+            return
+        with Pool(num_processes) as pool:
+            pending = deque()
+            for record in records:
+                pending.append(pool.apply_async(format_record, (record,)))
+                if len(pending) >= 2 * num_processes:
+                    outfile.write(pending.popleft().get())
+            while pending:
+                outfile.write(pending.popleft().get())
+
+
+REGION_SIZE = 1 << 20  # Minimum reference region per task
+
+
+def get_aln_gc(filename, threads=1):
+    """
+    Parses a SAM/BAM file one record at a time, decompressing with threads htslib
+    threads. Yields a tuple (name, gc count, length) for each read with a sequence.
+    """
+    with pysam.AlignmentFile(filename, check_sq=False, threads=threads) as aln_file:
+        for read in aln_file.fetch(until_eof=True):
+            seq = read.query_sequence
+            if seq:
+                yield read.query_name, count_gc(seq), len(seq)
+
+
+def get_regions(aln_file, num_regions):
+    """
+    Split the references of an indexed alignment file into about num_regions regions.
+    Returns a list of (contig, start, end) tuples, with ("*", 0, 0) for unplaced reads.
+    """
+    lengths = dict(zip(aln_file.references, aln_file.lengths))
+    size = max(REGION_SIZE, sum(lengths.values()) // max(1, num_regions))
+    regions = []
+    for contig, length in lengths.items():
+        for start in range(0, length, size):
+            regions.append((contig, start, min(start + size, length)))
+    regions.append(("*", 0, 0))
+    return regions
+
+
+def region_gc(filename, region):
+    """
+    Returns a tuple (gc count, length) summed over the reads that start in a region of
+    an indexed alignment file. Run by the worker processes in get_aln_gc_parallel.
+    """
+    contig, start, end = region
+    total_gc, total_length = 0, 0
+    with pysam.AlignmentFile(filename) as aln_file:
+        if contig == "*":
+            reads = aln_file.fetch(contig)
+        else:
+            reads = (read for read in aln_file.fetch(contig, start, end) if read.reference_start >= start)
+        for read in reads:
+            seq = read.query_sequence
+            if seq:
+                total_gc += count_gc(seq)
+                total_length += len(seq)
+    return total_gc, total_length
+
+
+def get_aln_gc_parallel(filename, num_processes):
+    """
+    Returns a tuple (gc count, length) summed over all reads of an indexed BAM/CRAM file,
+    counting reference regions in num_processes worker processes.
+    """
+    with pysam.AlignmentFile(filename) as aln_file:
+        regions = get_regions(aln_file, num_processes * 16)
+    total_gc, total_length = 0, 0
+    with Pool(num_processes) as pool:
+        for gc, length in pool.imap_unordered(partial(region_gc, filename), regions):
+            total_gc += gc
+            total_length += length
+    return total_gc, total_length
+
+
+def is_indexed(filename):
+    """Returns True if filename is an alignment file with an index."""
+    if filename == "-":
+        return False
+    try:
+        with pysam.AlignmentFile(filename, check_sq=False) as aln_file:
+            return aln_file.has_index()
+    except (ValueError, OSError):
+        return False
 
 
 def parse_args():
@@ -60,36 +219,90 @@ def parse_args():
     parser.add_argument("-p", "--per_seq",
                         action="store_true",
                         help="Calculate GC content per sequence and print in tabular (.tsv) format")
+    parser.add_argument("-n", "--num_processes",
+                        type=int,
+                        default=1,
+                        help="Number of processes for global or windowed FASTA/FASTQ GC content, "
+                             "or for global GC content of an indexed BAM; otherwise the number "
+                             "of BAM decompression threads [1]")
+    parser.add_argument("-w", "--window",
+                        type=int,
+                        default=None,
+                        help="Print GC content in windows of this size along each sequence (bedGraph)")
+    parser.add_argument("-s", "--step",
+                        type=int,
+                        default=None,
+                        help="Step between window starts [window size]")
+    parser.add_argument("--skew",
+                        action="store_true",
+                        help="Print GC skew, (G - C) / (G + C), instead of GC content in windows")
     
     return parser.parse_args()
 
 
+def print_total_gc(total_gc, total_length):
+    """Print the GC content of all sequences, or exit with an error if there are none."""
+    if total_length == 0:
+        print("gc_content.py: error: no sequence in input", file=sys.stderr, flush=True)
+        sys.exit(1)
+    print(total_gc / total_length)
+
+
 def main():
     args = parse_args()
     
-    # Get input file
-    if args.input == "-":
-        args.input = sys.stdin
-    
-    else:
+    # Get input file ('-' is read from stdin)
+    if args.input != "-":
         if not os.path.exists(args.input):
             print(f"gc_content.py: error: file {args.input} does not exist")
             sys.exit(1)
 
-    # Get sequences
+    if args.window is not None:
+        if args.filetype not in ("fasta", "fastq"):
+            print("gc_content.py: error: windowed GC content requires a FASTA or FASTQ file",
+                  file=sys.stderr, flush=True)
+            sys.exit(1)
+        step = args.window if args.step is None else args.step
+        if args.window < 1 or step < 1:
+            print("gc_content.py: error: window and step must be positive", file=sys.stderr, flush=True)
+            sys.exit(1)
+        write_gc_windows(args.input, args.window, step, args.skew, args.num_processes)
+        return
+
+    if (args.filetype == "fasta" or args.filetype == "fastq") and not args.per_seq \
+            and args.num_processes > 1:
+        total_gc, total_length = map_reduce_reads(args.input, batch_gc_totals, add_gc_totals,
+                                                  args.num_processes) or (0, 0)
+        print_total_gc(total_gc, total_length)
+        return
+
     if args.filetype == "fasta" or args.filetype == "fastq":
-        seqs = get_fastx_seqs(args.input, args.filetype)
-    else:
-        seqs = get_aln_seqs(args.input)
-    
+        total_gc, total_length = 0, 0
+        for names, gc_counts, lengths in get_fastx_gc(args.input):
+            if args.per_seq:
+                for name, gc, length in zip(names, gc_counts, lengths):
+                    print(name, gc / length, sep="\t")
+            else:
+                total_gc += sum(gc_counts)
+                total_length += sum(lengths)
+        if not args.per_seq:
+            print_total_gc(total_gc, total_length)
+        return
+
+    if not args.per_seq and args.num_processes > 1 and is_indexed(args.input):
+        total_gc, total_length = get_aln_gc_parallel(args.input, args.num_processes)
+        print_total_gc(total_gc, total_length)
+        return
+
+    total_gc, total_length = 0, 0
+    for name, gc, length in get_aln_gc(args.input, args.num_processes):
+        if args.per_seq:
+            print(name, gc / length, sep="\t")
+        else:
+            total_gc += gc
+            total_length += length
     if not args.per_seq:
-        entire_seq = "".join([seq for (name, seq) in seqs])
-        gc = calc_gc(entire_seq)
-        print(gc)
-    else:
-        for name, seq in seqs:
-            gc = calc_gc(seq)
-            print(name, gc, sep="\t")
+        print_total_gc(total_gc, total_length)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Compact membership table for read headers. Headers are stored as sorted 64-bit hashes
+(8 bytes per header) and queried in batches with np.searchsorted.
+"""
+
+import hashlib
+import numpy as np
+
+def hash_header(header):
+    """Returns a stable 64-bit hash of a read header (str or bytes)."""
+    if isinstance(header, str):
+        header = header.encode()
+    return int.from_bytes(hashlib.blake2b(header, digest_size=8).digest(), "little")
+
+
+def hash_headers(headers):
+    """Returns a uint64 array of the hashes of a list of headers."""
+    return np.fromiter((hash_header(h) for h in headers), dtype=np.uint64, count=len(headers))
+
+
+def mix_hashes(hashes, seed=0):
+    """
+    Returns seeded 64-bit hashes of a uint64 array (the splitmix64 finalizer applied to
+    hashes + seed). The same seed always gives the same values.
+    """
+    x = np.asarray(hashes, dtype=np.uint64) + np.uint64((seed * 0x9e3779b97f4a7c15) % (1 << 64))
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+class HeaderSet:
+    """
+    Set of read headers stored as a sorted array of 64-bit hashes, optionally with an
+    integer value per header (e.g. a partition index). If exact_headers (a set of the
+    header strings) is given, hash matches are verified against it, which rules out
+    false positives from hash collisions at the cost of the memory of the strings.
+    """
+    def __init__(self, hashes, values=None, exact_headers=None):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.values = None if values is None else np.asarray(values)[order]
+        self.exact_headers = exact_headers
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, header):
+        return bool(self.contains([header])[0])
+
+    def find(self, headers):
+        """Returns an array of the positions of headers in the table, -1 if absent."""
+        query = hash_headers(headers)
+        if len(self.hashes) == 0:
+            return np.full(len(query), -1, dtype=np.int64)
+        idx = np.searchsorted(self.hashes, query)
+        idx[idx == len(self.hashes)] = 0
+        found = self.hashes[idx] == query
+        if self.exact_headers is not None:
+            for i in np.flatnonzero(found):
+                found[i] = headers[i] in self.exact_headers
+        return np.where(found, idx, -1)
+
+    def contains(self, headers):
+        """Returns a boolean array, True where a header is in the table."""
+        return self.find(headers) >= 0
+
+    def get_values(self, headers, default=-1):
+        """Returns an array of the values stored for headers, default where absent."""
+        idx = self.find(headers)
+        if len(self.hashes) == 0:
+            return np.full(len(idx), default)
+        values = self.values[idx]
+        values[idx < 0] = default
+        return values
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Count k-mers as 2-bit encoded integers with NumPy. A k-mer is stored in ceil(k / 32)
+uint64 words, most significant first: the first word holds the first k - 32 * (words - 1)
+bases and every other word holds 32 bases (A=0, C=1, G=2, T=3). K-mers containing a
+base other than ACGT (either case) are skipped.
+"""
+
+import os
+import glob
+import numpy as np
+from utils.header_set import mix_hashes
+
+MERGE_SIZE = 1 << 22
+PARTITION_SEED = 1 << 21  # Seed of the partition hash, independent of other k-mer hashes
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b"ACGT"):
+    BASE_CODES[base] = code
+    BASE_CODES[base + 32] = code  # Lower case
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+EVEN_BITS = np.uint64(0x5555555555555555)
+
+
+def num_words(k):
+    """Returns the number of uint64 words used for a k-mer."""
+    return -(-k // 32)
+
+
+def encode_words(codes, k):
+    """
+    Returns a uint64 array with the 2-bit encoding of codes[i:i + k] (k <= 32) at each
+    position i, built by doubling (O(n log k) vector operations).
+    """
+    result, result_len = None, 0
+    power, power_len = codes.astype(np.uint64), 1
+    while k:
+        if k & 1:
+            if result is None:
+                result, result_len = power, power_len
+            else:
+                m = len(result) - power_len
+                result = (result[:m] << np.uint64(2 * power_len)) | power[result_len:result_len + m]
+                result_len += power_len
+        k >>= 1
+        if k:
+            m = len(power) - power_len
+            power = (power[:m] << np.uint64(2 * power_len)) | power[power_len:power_len + m]
+            power_len *= 2
+    return result
+
+
+def encode_kmers(codes, k):
+    """
+    Returns a (positions, words) uint64 array with the encoding of the k-mer starting at
+    each position of an array of 2-bit base codes.
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros((0, num_words(k)), dtype=np.uint64)
+    head = k - 32 * (num_words(k) - 1)
+    words = [encode_words(codes, head)[:n]]
+    if num_words(k) > 1:
+        full = encode_words(codes, 32)
+        for start in range(head, k, 32):
+            words.append(full[start:start + n])
+    return np.stack(words, axis=1)
+
+
+def less_than(a, b):
+    """Returns a boolean array, True where the k-mer in row i of a sorts before row i of b."""
+    less = np.zeros(len(a), dtype=bool)
+    decided = np.zeros(len(a), dtype=bool)
+    for w in range(a.shape[1]):
+        less |= ~decided & (a[:, w] < b[:, w])
+        decided |= a[:, w] != b[:, w]
+    return less
+
+
+def batch_kmers(seq, offsets, k, canonical=False):
+    """
+    Returns a (kmers, words) uint64 array of the k-mers of the sequences in a bytes
+    buffer, where sequence i spans seq[offsets[i]:offsets[i + 1]]. K-mers spanning two
+    sequences or containing non-ACGT bases are skipped. If canonical is True, each
+    k-mer is replaced by the smaller of itself and its reverse complement.
+    """
+    codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros((0, num_words(k)), dtype=np.uint64)
+    invalid = codes > 3
+    codes[invalid] = 0
+    bad = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(invalid, out=bad[1:])
+    seq_ends = np.repeat(offsets[1:], np.diff(offsets))[:n]
+    positions = np.arange(n)
+    keep = (positions + k <= seq_ends) & (bad[k:] == bad[:n])
+
+    kmers = encode_kmers(codes, k)[keep]
+    if canonical:
+        reverse = encode_kmers(3 - codes[::-1], k)[::-1][keep]
+        swap = less_than(reverse, kmers)
+        kmers[swap] = reverse[swap]
+    return kmers
+
+
+def as_keys(kmers):
+    """Returns a 1-d array of sortable keys for a (kmers, words) array."""
+    if kmers.shape[1] == 1:
+        return kmers[:, 0]
+    return np.ascontiguousarray(kmers).view(np.dtype((np.void, 8 * kmers.shape[1]))).ravel()
+
+
+def from_keys(keys, words):
+    """Returns the (kmers, words) uint64 array of keys from as_keys."""
+    return np.ascontiguousarray(keys).view(np.uint64).reshape(-1, words)
+
+
+def merge_counts(keys, counts):
+    """Sort keys and sum the counts of runs of equal keys. Returns (unique keys, counts)."""
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    counts = counts[order]
+    if len(keys) == 0:
+        return keys, counts
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+def gc_counts(kmers):
+    """Returns the number of G/C bases in each k-mer of a (kmers, words) array."""
+    bits = (kmers ^ (kmers >> np.uint64(1))) & EVEN_BITS  # 1 for C (01) and G (10)
+    bytes_per_kmer = 8 * kmers.shape[1]
+    return POPCOUNT[np.ascontiguousarray(bits).view(np.uint8)].reshape(len(kmers), bytes_per_kmer).sum(axis=1)
+
+
+def hash_kmers(kmers, seed=0):
+    """Returns a seeded uint64 hash of each k-mer of a (kmers, words) array."""
+    hashes = np.zeros(len(kmers), dtype=np.uint64)
+    for w in range(kmers.shape[1]):
+        hashes = mix_hashes(hashes ^ kmers[:, w], seed)
+    return hashes
+
+
+def partition_kmers(kmers, num_partitions):
+    """Returns the partition (0 to num_partitions - 1) of each k-mer, chosen by hash."""
+    return (hash_kmers(kmers, PARTITION_SEED) % np.uint64(num_partitions)).astype(np.int64)
+
+
+def spill_counts(kmers, counts, num_partitions, directory, suffix):
+    """
+    Split (kmers, words) k-mers and their counts by partition and append them to the
+    run files partition{p}.{suffix}.kmers and .counts in directory. Each file must have
+    only one writer (e.g. use the process id as suffix).
+    """
+    parts = partition_kmers(kmers, num_partitions)
+    order = np.argsort(parts, kind="stable")
+    bounds = np.searchsorted(parts[order], np.arange(num_partitions + 1))
+    kmers = kmers[order]
+    counts = counts[order].astype(np.uint32)
+    for p in range(num_partitions):
+        start, end = bounds[p], bounds[p + 1]
+        if start == end:
+            continue
+        prefix = os.path.join(directory, "partition{0}.{1}".format(p, suffix))
+        with open(prefix + ".kmers", "ab") as fh:
+            fh.write(np.ascontiguousarray(kmers[start:end]).tobytes())
+        with open(prefix + ".counts", "ab") as fh:
+            fh.write(counts[start:end].tobytes())
+
+
+def read_partition(directory, partition, words):
+    """Yields (keys, counts) tuples from the run files of a partition (see spill_counts)."""
+    for name in sorted(glob.glob(os.path.join(directory, "partition{0}.*.counts".format(partition)))):
+        prefix = name[:-len(".counts")]
+        counts = np.fromfile(name, dtype=np.uint32)
+        kmers = np.fromfile(prefix + ".kmers", dtype=np.uint64).reshape(-1, words)
+        yield as_keys(kmers), counts
+
+
+def decode_kmers(kmers, k):
+    """Decode a (kmers, words) array to a list of k-mer strings."""
+    head = k - 32 * (kmers.shape[1] - 1)
+    decoded = []
+    for row in kmers.tolist():
+        bases = []
+        for w, word in enumerate(row):
+            length = head if w == 0 else 32
+            bases.extend("ACGT"[(word >> (2 * i)) & 3] for i in range(length - 1, -1, -1))
+        decoded.append("".join(bases))
+    return decoded
+
+
+class KmerCounter:
+    """
+    Counts k-mers in batches of sequences. Each batch is sorted and run-length counted
+    with np.unique, and partial counts are merged once they outgrow the merged table.
+    """
+    def __init__(self, k, canonical=False):
+        self.k = k
+        self.canonical = canonical
+        self.words = num_words(k)
+        self.keys = as_keys(np.zeros((0, self.words), dtype=np.uint64))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def add(self, seq, offsets):
+        """Count the k-mers of a buffer of sequences (see batch_kmers) and return self."""
+        keys, counts = np.unique(as_keys(batch_kmers(seq, offsets, self.k, self.canonical)),
+                                 return_counts=True)
+        self.add_counts(keys, counts)
+        return self
+
+    def add_batch(self, batch):
+        """Count the k-mers of a FastxBatch and return self."""
+        return self.add(batch.seq, batch.offsets)
+
+    def add_counts(self, keys, counts):
+        """Add counts for an array of keys."""
+        self.pending.append((keys, counts.astype(np.int64)))
+        self.pending_size += len(keys)
+        if self.pending_size > max(len(self.keys), MERGE_SIZE):
+            self.merge()
+
+    def merge(self):
+        """Merge pending partial counts into the count table."""
+        if self.pending:
+            keys = np.concatenate([self.keys] + [k for k, _ in self.pending])
+            counts = np.concatenate([self.counts] + [c for _, c in self.pending])
+            self.keys, self.counts = merge_counts(keys, counts)
+            self.pending = []
+            self.pending_size = 0
+
+    def update(self, other):
+        """Add the counts of another KmerCounter and return self."""
+        other.merge()
+        self.add_counts(other.keys, other.counts)
+        return self
+
+    def __len__(self):
+        self.merge()
+        return len(self.keys)
+
+    def filter(self, min_count):
+        """Drop k-mers counted fewer than min_count times and return self."""
+        self.merge()
+        keep = self.counts >= min_count
+        self.keys = self.keys[keep]
+        self.counts = self.counts[keep]
+        return self
+
+    def kmers(self):
+        """Returns a tuple ((kmers, words) uint64 array, counts) of the counted k-mers."""
+        self.merge()
+        return from_keys(self.keys, self.words), self.counts
+
+    def to_dict(self):
+        """Returns a dictionary of k-mer string -> count."""
+        kmers, counts = self.kmers()
+        return dict(zip(decode_kmers(kmers, self.k), counts.tolist()))
+
+
+class CountMinSketch:
+    """
+    Count-min sketch of k-mer counts in a fixed depth x width table of uint32 counters
+    (width a power of two), with conservative update: a k-mer only raises its counters
+    to its new estimate. Estimates are never below the true count. With N k-mers
+    counted in total, an estimate exceeds the true count by more than e * N / width
+    with probability at most exp(-depth) (conservative update only makes this rarer).
+    """
+    def __init__(self, width, depth=4):
+        if width & (width - 1):
+            raise ValueError("sketch width must be a power of two")
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.uint32)
+        self.total = 0
+
+    @classmethod
+    def from_memory(cls, memory, depth=4):
+        """Returns the widest sketch that fits in memory bytes."""
+        width = 1 << max(0, (memory // (4 * depth)).bit_length() - 1)
+        return cls(width, depth)
+
+    def cells(self, kmers):
+        """Returns a (depth, kmers) array of the counter of each k-mer in each row."""
+        hashes = hash_kmers(kmers)
+        mask = np.uint64(self.width - 1)
+        return np.stack([mix_hashes(hashes, row + 1) & mask for row in range(self.depth)]).astype(np.int64)
+
+    def add(self, kmers, counts):
+        """Add counts for a (kmers, words) array of distinct k-mers."""
+        cells = self.cells(kmers)
+        estimates = self.table[np.arange(self.depth)[:, None], cells].min(axis=0)
+        new = np.minimum(estimates.astype(np.int64) + counts, np.iinfo(np.uint32).max).astype(np.uint32)
+        for row in range(self.depth):
+            np.maximum.at(self.table[row], cells[row], new)
+        self.total += int(counts.sum())
+
+    def query(self, kmers):
+        """Returns an array of the estimated count of each k-mer."""
+        cells = self.cells(kmers)
+        return self.table[np.arange(self.depth)[:, None], cells].min(axis=0).astype(np.int64)
+
+    def error_bound(self):
+        """Returns e * N / width, the overestimate exceeded with probability <= exp(-depth)."""
+        return np.e * self.total / self.width
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Open a plain, gzip or BGZF-compressed read file. The format is detected from the
+file's magic bytes, so file extensions do not matter.
+"""
+
+import gzip
+import io
+import sys
+from utils.bgzf import BgzfReader, is_bgzf, DEFAULT_THREADS
+
+BUFFER_SIZE = 1 << 20
+
+def detect_format(fh):
+    """Returns 'bgzf', 'gzip' or 'plain' for a buffered binary handle, without consuming it."""
+    header = fh.peek(18)[:18]
+    if is_bgzf(header):
+        return "bgzf"
+    if header[:2] == b"\x1f\x8b":
+        return "gzip"
+    return "plain"
+
+
+def skip_bytes(stream, offset):
+    """Read and discard offset bytes from stream."""
+    while offset > 0:
+        chunk = stream.read(min(offset, BUFFER_SIZE))
+        if not chunk:
+            raise EOFError("read file ended before offset to resume from")
+        offset -= len(chunk)
+
+
+def open_reads(filename, text=False, threads=DEFAULT_THREADS, offset=0, virtual_offset=None):
+    """
+    Open a read file ('-' for stdin) for reading and return a buffered binary stream,
+    or a text stream if text is True. BGZF input is decompressed in a pool of threads;
+    other gzip input is decompressed with the gzip module.
+
+    Reading starts at the uncompressed byte offset. BGZF input seeks directly to
+    virtual_offset (the virtual offset of offset, see get_virtual_offset) if it is
+    given, and plain files are seeked to offset; otherwise the input is decompressed
+    and skipped up to offset.
+    """
+    if filename == "-" or filename == "/dev/stdin":
+        fh = sys.stdin.buffer
+    else:
+        fh = open(filename, "rb", buffering=BUFFER_SIZE)
+
+    file_format = detect_format(fh)
+    if file_format == "bgzf":
+        raw = BgzfReader(fh, threads)
+        if offset and virtual_offset is not None:
+            raw.seek_virtual(virtual_offset, offset)
+            offset = 0
+        stream = io.BufferedReader(raw, buffer_size=BUFFER_SIZE)
+    elif file_format == "gzip":
+        if fh is sys.stdin.buffer:
+            stream = gzip.GzipFile(fileobj=fh)
+        else:
+            fh.close()
+            stream = gzip.GzipFile(filename)
+    else:
+        stream = fh
+        if offset and fh is not sys.stdin.buffer:
+            fh.seek(offset)
+            offset = 0
+    skip_bytes(stream, offset)
+
+    if text:
+        return io.TextIOWrapper(stream)
+    return stream
+
+
+def get_virtual_offset(stream, offset):
+    """
+    Returns the BGZF virtual offset of the uncompressed offset in a binary stream from
+    open_reads, or None if the stream is not BGZF or offset is not near its position.
+    """
+    raw = getattr(stream, "raw", None)
+    if isinstance(raw, BgzfReader):
+        return raw.virtual_offset(offset)
+    return None
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Parse an uncompressed FASTA/FASTQ file in parallel. The file is split into byte ranges
+that are moved forward to the next valid record boundary, each range is parsed in a
+process pool and the per-shard results are merged with a reducer.
+"""
+
+import os
+from multiprocessing import Pool, cpu_count
+from utils.read_fasta import read_fasta_batches, BATCH_SIZE
+from utils.open_reads import open_reads, detect_format
+
+def sync_fastq(fh, offset):
+    """
+    Returns the offset of the first FASTQ record starting at or after offset. A record
+    starts at a line beginning with '@' that is followed by a sequence line, a line
+    beginning with '+' and a quality line of the same length as the sequence.
+    """
+    if offset <= 0:
+        return 0
+    fh.seek(offset - 1)
+    fh.readline()  # Move to the start of the next line
+    pos = fh.tell()
+    lines = [fh.readline() for _ in range(4)]
+    while lines[0]:
+        if lines[0][:1] == b"@" and lines[2][:1] == b"+" and lines[3] \
+                and len(lines[3].rstrip(b"\r\n")) == len(lines[1].rstrip(b"\r\n")):
+            return pos
+        pos += len(lines[0])
+        lines = lines[1:] + [fh.readline()]
+    return pos
+
+
+def sync_fasta(fh, offset):
+    """Returns the offset of the first FASTA header line starting at or after offset."""
+    if offset <= 0:
+        return 0
+    fh.seek(offset - 1)
+    fh.readline()
+    pos = fh.tell()
+    for line in iter(fh.readline, b""):
+        if line[:1] == b">":
+            return pos
+        pos += len(line)
+    return pos
+
+
+def get_shards(filename, num_shards):
+    """
+    Split an uncompressed FASTA/FASTQ file into at most num_shards byte ranges that
+    each start on a record boundary. Returns a list of (start, end) tuples.
+    """
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as fh:
+        first = fh.read(1)
+        sync = sync_fastq if first == b"@" else sync_fasta
+        step = size // num_shards
+        bounds = [0]
+        for i in range(1, num_shards):
+            bound = sync(fh, i * step)
+            if bound > bounds[-1]:
+                bounds.append(bound)
+    if bounds[-1] < size:
+        bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+class ShardReader:
+    """Binary file-like object that reads at most length bytes from fh."""
+    def __init__(self, fh, length):
+        self.fh = fh
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fh.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def is_plain_file(filename):
+    """Returns True if filename is a regular, uncompressed file."""
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, "rb") as fh:
+        return detect_format(fh) == "plain"
+
+
+def reduce_batches(batches, map_batch, reduce):
+    """Apply map_batch to each batch and merge the results with reduce."""
+    result = None
+    for batch in batches:
+        value = map_batch(batch)
+        result = value if result is None else reduce(result, value)
+    return result
+
+
+def run_shard(shard_args):
+    """Parse a single shard. Run by the worker processes in map_reduce_reads."""
+    filename, start, end, map_batch, reduce, batch_size = shard_args
+    with open(filename, "rb") as fh:
+        fh.seek(start)
+        return reduce_batches(read_fasta_batches(ShardReader(fh, end - start), batch_size),
+                              map_batch, reduce)
+
+
+def map_reduce_reads(filename, map_batch, reduce, processes=None, batch_size=BATCH_SIZE):
+    """
+    Compute map_batch over every FastxBatch in filename and merge the results with
+    reduce(a, b), which must be associative and accept its own output. Uncompressed
+    regular files are split into shards and parsed by a pool of processes; other
+    inputs (e.g. pipes, gzip and BGZF files) are parsed serially through open_reads.
+    Both functions must be picklable
+    (defined at module level). Returns None if the file has no records.
+    """
+    if processes is None:
+        processes = cpu_count()
+    if processes <= 1 or not is_plain_file(filename):
+        with open_reads(filename) as fh:
+            return reduce_batches(read_fasta_batches(fh, batch_size), map_batch, reduce)
+
+    shards = get_shards(filename, processes)
+    if not shards:
+        return None
+    with Pool(min(processes, len(shards))) as pool:
+        results = pool.map(run_shard, [(filename, start, end, map_batch, reduce, batch_size)
+                                       for start, end in shards])
+    result = None
+    for value in results:
+        if value is not None:
+            result = value if result is None else reduce(result, value)
+    return result
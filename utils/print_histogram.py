@@ -5,23 +5,121 @@ import sys
 import argparse
 import numpy as np
 
+VALUE_BATCH_SIZE = 65536
+
+class StreamingHistogram:
+    """
+    Histogram of non-negative values that are added in batches, so the values never
+    need to be held in memory at once. Bin i holds values in [i * bin_width,
+    (i + 1) * bin_width) and bins are added as larger values arrive. If max_bins is
+    given, bins are adaptive: whenever there would be more than max_bins bins, the bin
+    width doubles and neighbouring bins are combined. Histograms can be merged (e.g.
+    across processes) and saved to disk.
+    """
+    def __init__(self, bin_width, max_bins=None, counts=None):
+        self.bin_width = bin_width
+        self.max_bins = max_bins
+        self.counts = np.zeros(0, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.counts)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a histogram written by save."""
+        with np.load(filename) as hist:
+            max_bins = int(hist["max_bins"]) or None
+            return cls(hist["bin_width"].item(), max_bins, hist["counts"])
+
+    def save(self, filename):
+        """Save the histogram as an uncompressed .npz file."""
+        with open(filename, "wb") as fh:
+            np.savez(fh, bin_width=self.bin_width, max_bins=self.max_bins or 0, counts=self.counts)
+
+    def coarsen(self, bin_width):
+        """Combine bins until the bin width is bin_width (bin_width * 2 ** k)."""
+        while self.bin_width < bin_width:
+            counts = np.pad(self.counts, (0, len(self.counts) % 2))
+            self.counts = counts[0::2] + counts[1::2]
+            self.bin_width *= 2
+
+    def add_counts(self, counts):
+        """Add an array of bin counts with the same bin width, growing the bins if needed."""
+        size = max(len(self.counts), len(counts))
+        self.counts = np.pad(self.counts, (0, size - len(self.counts)))
+        self.counts[:len(counts)] += counts
+        while self.max_bins and len(self.counts) > self.max_bins:
+            self.coarsen(self.bin_width * 2)
+
+    def add(self, values):
+        """Add an array of values (negative values are ignored) and return self."""
+        values = np.asarray(values)
+        values = values[values >= 0]
+        if len(values) == 0:
+            return self
+        if self.max_bins:
+            width = self.bin_width
+            while values.max() // width >= self.max_bins:
+                width *= 2
+            self.coarsen(width)
+        self.add_counts(np.bincount((values // self.bin_width).astype(np.int64)))
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another StreamingHistogram and return self. The bin widths
+        must differ by a power of two (as adaptive histograms with the same starting
+        width do); the result has the larger width.
+        """
+        other_counts = other.counts
+        if other.bin_width > self.bin_width:
+            self.coarsen(other.bin_width)
+        elif other.bin_width < self.bin_width:
+            other = StreamingHistogram(other.bin_width, counts=other.counts)
+            other.coarsen(self.bin_width)
+            other_counts = other.counts
+        self.add_counts(other_counts)
+        return self
+
+    def print_histogram(self, outfile=None, name=None):
+        """
+        Print the histogram in tsv format: the upper edge of each bin and its count,
+        followed by name if it is given. By default prints to stdout.
+        """
+        of = sys.stdout if outfile is None else outfile
+        suffix = () if name is None else (name,)
+        for i, count in enumerate(self.counts.tolist()):
+            edge = (i + 1) * self.bin_width
+            print(int(edge) if float(edge).is_integer() else edge, count, *suffix, sep="\t", file=of)
+
+
 def print_histogram(values, binwidth, outfile=None):
     """
     Given a list of values and desired bin width, prints a histogram of values
     in tsv format. By default prints histogram to stdout.
     """
-    max_val = np.max(values)
-    # Calculate bin width and max
-    upper_lim = max_val + (binwidth - (max_val % binwidth))
-    bins = upper_lim // binwidth
-    counts, bins = np.histogram(values, int(bins), range=(0, upper_lim))
+    hist = StreamingHistogram(binwidth).add(values)
     if outfile is None:
-        of = sys.stdout
+        hist.print_histogram()
     else:
-        of = open(outfile, "w+")
-    for i, bin in enumerate(bins[1:]):
-        print(int(bin), counts[i], sep="\t", file=of)
-    of.close()
+        with open(outfile, "w+") as of:
+            hist.print_histogram(of)
+
+
+def read_values(infile, batch_size=VALUE_BATCH_SIZE):
+    """Yields arrays of up to batch_size numeric values, one per line of infile."""
+    values = []
+    for line in infile:
+        try:
+            values.append(float(line.strip()))
+        except ValueError:
+            print("error: values must be numeric")
+            sys.exit(1)
+        if len(values) == batch_size:
+            yield np.array(values)
+            values = []
+    if values:
+        yield np.array(values)
 
 
 def parse_args():
@@ -39,21 +137,24 @@ def parse_args():
                         type=int,
                         required=True,
                         help="Bin width for histogram")
+    parser.add_argument("-m", "--max_bins",
+                        type=int,
+                        default=None,
+                        help="Maximum number of bins; the bin width is doubled as needed")
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    hist_vals = []
+    hist = StreamingHistogram(args.binwidth, args.max_bins)
     with open(args.input, "r") as infile:
-        for line in infile:
-            try:
-                hist_vals.append(float(line.strip()))
-            except ValueError:
-                print("error: values must be numeric")
-                sys.exit(1)
-    
-    print_histogram(hist_vals, args.binwidth, args.outfile)
+        for values in read_values(infile):
+            hist.add(values)
+    if args.outfile is None:
+        hist.print_histogram()
+    else:
+        with open(args.outfile, "w+") as of:
+            hist.print_histogram(of)
 
 
 if __name__ == "__main__":
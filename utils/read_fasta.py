@@ -5,6 +5,8 @@ Written by Heng Li
 See https://github.com/lh3/readfq
 """
 
+import numpy as np
+
 def read_fasta(fin):
     "Read a FASTA/FASTQ file."
     last = None # this is a buffer keeping the last unprocessed line
@@ -46,3 +48,151 @@ def read_fasta(fin):
             if last: # reach EOF before reading enough quality
                 yield name, seq, bx, None # yield a fasta record instead
                 break
+
+
+CHUNK_SIZE = 1 << 22  # 4 MiB
+BATCH_SIZE = 65536
+
+
+def iter_lines(fin, chunk_size=CHUNK_SIZE):
+    """
+    Yield lines (as bytes, without the trailing newline) from a binary file handle,
+    reading chunk_size bytes at a time and splitting on newline offsets.
+    """
+    fin = getattr(fin, "buffer", fin)  # Accept text handles such as sys.stdin
+    rest = b""
+    while True:
+        chunk = fin.read(chunk_size)
+        if not chunk:
+            break
+        buf = rest + chunk if rest else chunk
+        find = buf.find
+        start = 0
+        end = find(b"\n")
+        while end >= 0:
+            yield buf[start:end]
+            start = end + 1
+            end = find(b"\n", start)
+        rest = buf[start:]
+    if rest:
+        yield rest
+
+
+def read_fasta_bytes(fin, chunk_size=CHUNK_SIZE, comments=False):
+    """
+    Read a FASTA/FASTQ file from a binary handle in large chunks. Yields the same
+    (name, seq, bx, qual) tuples as read_fasta, but as bytes instead of str. If
+    comments is True, the whole header comment (or None) is yielded in place of bx.
+    """
+    lines = iter_lines(fin, chunk_size)
+    last = None
+    while True:
+        if not last:
+            for line in lines:
+                first = line[:1]
+                if first == b">" or first == b"@":
+                    last = line
+                    break
+        if not last:
+            break
+        xs = last[1:].split(None, 1)
+        if len(xs) == 1:
+            name = xs[0]
+            bx = None
+        else:
+            name, bx = xs
+            if not comments:
+                bx = bx[5:] if bx.startswith(b"BX:Z:") else None
+        seqs = []
+        last = None
+        for line in lines:
+            if line[:1] in (b"@", b"+", b">"):
+                last = line
+                break
+            seqs.append(line)
+        seq = seqs[0] if len(seqs) == 1 else b"".join(seqs)
+        if not last or last[:1] != b"+":  # FASTA record
+            yield name, seq, bx, None
+            if not last:
+                break
+        else:  # FASTQ record
+            leng, quals = 0, []
+            for line in lines:
+                quals.append(line)
+                leng += len(line)
+                if leng >= len(seq):
+                    last = None
+                    yield name, seq, bx, quals[0] if len(quals) == 1 else b"".join(quals)
+                    break
+            if last:  # Reached EOF before reading enough quality
+                yield name, seq, bx, None
+                break
+
+
+class FastxBatch:
+    """
+    A block of FASTA/FASTQ records stored column-wise. Sequences (and qualities, if
+    every record has one) are concatenated into a single bytes buffer; record i spans
+    seq[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, names, bxs, seq, offsets, qual=None):
+        self.names = names
+        self.bxs = bxs
+        self.seq = seq
+        self.offsets = offsets
+        self.qual = qual
+
+    @classmethod
+    def from_records(cls, names, seqs, bxs, quals):
+        """Build a batch from lists of per-record bytes."""
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in seqs], dtype=np.int64, out=offsets[1:])
+        qual = None if None in quals else b"".join(quals)
+        return cls(names, bxs, b"".join(seqs), offsets, qual)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        """Iterate over the batch as (name, seq, bx, qual) records."""
+        for i, name in enumerate(self.names):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            qual = self.qual[start:end] if self.qual is not None else None
+            yield name, self.seq[start:end], self.bxs[i], qual
+
+    def lengths(self):
+        """Returns an array of sequence lengths."""
+        return np.diff(self.offsets)
+
+    def seq_array(self):
+        """Returns the concatenated sequences as a uint8 array (no copy)."""
+        return np.frombuffer(self.seq, dtype=np.uint8)
+
+    def gc_counts(self):
+        """Returns an array with the number of G/C bases (either case) in each record."""
+        is_gc = _GC_LOOKUP[self.seq_array()]
+        cumulative = np.zeros(len(is_gc) + 1, dtype=np.int64)
+        np.cumsum(is_gc, dtype=np.int64, out=cumulative[1:])
+        return cumulative[self.offsets[1:]] - cumulative[self.offsets[:-1]]
+
+
+_GC_LOOKUP = np.zeros(256, dtype=np.uint8)
+_GC_LOOKUP[list(b"GCgc")] = 1
+
+
+def read_fasta_batches(fin, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE):
+    """
+    Read a FASTA/FASTQ file from a binary handle and yield FastxBatch objects of
+    up to batch_size records.
+    """
+    names, seqs, bxs, quals = [], [], [], []
+    for name, seq, bx, qual in read_fasta_bytes(fin, chunk_size):
+        names.append(name)
+        seqs.append(seq)
+        bxs.append(bx)
+        quals.append(qual)
+        if len(names) == batch_size:
+            yield FastxBatch.from_records(names, seqs, bxs, quals)
+            names, seqs, bxs, quals = [], [], [], []
+    if names:
+        yield FastxBatch.from_records(names, seqs, bxs, quals)